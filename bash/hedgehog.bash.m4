@@ -15,7 +15,8 @@ _complete_sshansible() {
 						return
 					fi
 				done
-				COMPREPLY=($(compgen -W "$(INSTALL_DIR/bin/sshansible --complete-hosts)" "${COMP_WORDS[$COMP_CWORD]}"))
+				# Matches are filtered and ranked by sshansible, including fuzzy matches.
+				COMPREPLY=($(INSTALL_DIR/bin/sshansible --complete-hosts "${COMP_WORDS[$COMP_CWORD]}"))
 			fi
 			;;
 	esac
@@ -52,10 +53,15 @@ cdg() {
         INSTALL_DIR/bin/fzfdirs "$@"
         return
     fi
-    dir=$(INSTALL_DIR/bin/fzfdirs | fzf-tmux -- --reverse | cut -f 1)
+    dir=$(INSTALL_DIR/bin/fzfdirs --stream | fzf-tmux -- --reverse | cut -f 1)
     cd "$dir" || return
 	INSTALL_DIR/bin/fzfdirs --add-recent $(pwd)
 }
 
 export -f cdg ds
+
+# Optional resident daemon, which the functions above use when it's running.
+if [ -n "${HEDGEHOG_DAEMON:-}" ]; then
+    INSTALL_DIR/bin/hedgehogd --detach
+fi
 export PATH="$PATH:INSTALL_DIR/bin"
@@ -1,24 +1,55 @@
-import argparse
-import importlib.metadata
-import importlib.resources
-import json
+from __future__ import annotations
+
+import importlib
 import logging
 import os
 import pathlib
-import shlex
 import sys
 
 from typing import Callable, Union, Tuple
 
-import termcolor
-
 CACHE_DIR = pathlib.Path.home() / ".cache/hedgehog"
 CONFIG_DIR = pathlib.Path.home() / ".config/hedgehog"
 TEMP_DIR = pathlib.Path(os.environ.get("XDG_RUNTIME_DIR", "/tmp")) / "hedgehog"
-META_FILE = importlib.resources.files(__package__) / "meta.json"
 _CALLED_FROM_TEST = False
 
 
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access."""
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = sys.modules.get(self.__name) or importlib.import_module(self.__name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self.__name!r}>"
+
+
+def lazy_import(name: str):
+    """Return a module object for `name`, which isn't imported until used.
+
+    Use for modules that are expensive to import and not needed on every code
+    path, to keep startup of the shell hooks fast."""
+    return _LazyModule(name)
+
+
+argparse = lazy_import("argparse")
+json = lazy_import("json")
+shlex = lazy_import("shlex")
+termcolor = lazy_import("termcolor")
+
+
+def __getattr__(name):
+    if name == "META_FILE":
+        import importlib.resources
+
+        return importlib.resources.files(__package__) / "meta.json"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class Error(Exception):
     """Exceptions originating from Hedgehog toolset."""
 
@@ -40,6 +71,7 @@ class Print:
 
     def __init__(self, color):
         self.color = color
+        self._codes = {}
 
     @classmethod
     def instance(cls, color=False):
@@ -56,9 +88,33 @@ class Print:
 
     def colored(self, string, /, color=None, *, attrs=None):
         if self.color:
-            return termcolor.colored(string, color=color, attrs=attrs)
+            prefix, suffix = self.codes(color, attrs=attrs)
+            return f"{prefix}{string}{suffix}"
         return string
 
+    def codes(self, color=None, *, attrs=None) -> Tuple[str, str]:
+        """Return (prefix, suffix) strings which color text put between them
+        like `colored()` does. Use for many strings in the same color."""
+        key = (self.color, color, tuple(attrs or ()))
+        try:
+            return self._codes[key]
+        except KeyError:
+            pass
+        codes = ("", "")
+        if self.color:
+            colored = termcolor.colored("\0", color=color, attrs=attrs)
+            prefix, _, suffix = colored.partition("\0")
+            codes = (prefix, suffix)
+        self._codes[key] = codes
+        return codes
+
+    def write_lines(self, lines, /, *, file=None):
+        """Write already formatted `lines`, adding newlines, with one write
+        call to `file` (default: stdout), and flush it."""
+        file = file or sys.stdout
+        file.write("".join(f"{line}\n" for line in lines))
+        file.flush()
+
 
 class Logger(logging.getLoggerClass()):
 
@@ -95,19 +151,36 @@ class Logger(logging.getLoggerClass()):
     #     return rv
 
 
+def _version(prog: str) -> str:
+    import importlib.metadata
+
+    return "{} {}\nPython: {} from {}".format(
+        prog,
+        importlib.metadata.version(__package__),
+        ".".join((str(x) for x in sys.version_info[:3])),
+        sys.exec_prefix,
+    )
+
+
 def _argument_parser(logger: bool, argp_kwargs: dict):
     """Initialize an ArgumentParser with some default arguments."""
+
+    class VersionAction(argparse.Action):
+        """Print version and exit. Package metadata is only read when the
+        option is actually given."""
+
+        def __call__(self, parser, namespace, values, option_string=None):
+            print(_version(parser.prog))
+            parser.exit()
+
     argp_kwargs.setdefault("formatter_class", argparse.RawDescriptionHelpFormatter)
     par = argparse.ArgumentParser(**argp_kwargs)
     par.add_argument(
         "-V",
         "--version",
-        action="version",
-        version="%(prog)s {}\nPython: {} from {}".format(
-            importlib.metadata.version(__package__),
-            ".".join((str(x) for x in sys.version_info[:3])),
-            sys.exec_prefix,
-        ),
+        action=VersionAction,
+        nargs=0,
+        help="show program's version number and exit",
     )
     par.add_argument(
         "--color",
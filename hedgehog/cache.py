@@ -0,0 +1,100 @@
+"""
+Small on-disk caches for parsed data, stored under `hedgehog.CACHE_DIR`.
+"""
+import contextlib
+import logging
+import os
+import pathlib
+import pickle
+
+from typing import IO, Any, Iterator, Union
+
+import hedgehog
+
+hashlib = hedgehog.lazy_import("hashlib")
+tempfile = hedgehog.lazy_import("tempfile")
+
+log = logging.getLogger(__name__)
+
+
+def file_key(path: Union[str, pathlib.Path]) -> tuple:
+    """Return a key identifying the current contents of file `path`, built from
+    its absolute path, mtime, size and inode. Raise OSError if it can't be
+    stat'ed."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+@contextlib.contextmanager
+def atomic_open(
+    path: Union[str, pathlib.Path], /, mode: str = "wb", perm: int = None
+) -> Iterator[IO]:
+    """Open a temp file next to `path` for writing, and rename it in place when
+    the block exits without error, so readers never see a partially written
+    file."""
+    path = pathlib.Path(path)
+    fd, tempname = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with open(fd, mode) as fp:
+            yield fp
+        if perm is not None:
+            os.chmod(tempname, perm)
+        os.replace(tempname, path)
+    except BaseException:
+        os.unlink(tempname)
+        raise
+
+
+def atomic_write(path: Union[str, pathlib.Path], data: bytes, /, mode: int = None):
+    """Write `data` to `path` with `atomic_open()`."""
+    with atomic_open(path, perm=mode) as fp:
+        fp.write(data)
+
+
+class FileCache:
+    """Cache of values computed from a source file.
+
+    Each source file gets its own cache file, which is valid for as long as
+    `file_key()` of the source is unchanged. Bump `version` when the format of
+    the cached values changes.
+    """
+
+    VERSION = 1
+
+    def __init__(self, name: str, version: int = 1):
+        self.name = name
+        self.version = (self.VERSION, version)
+
+    def _cache_path(self, source: str) -> pathlib.Path:
+        digest = hashlib.sha1(source.encode()).hexdigest()[:16]
+        return hedgehog.CACHE_DIR / f"{self.name}-{digest}.pickle"
+
+    def get(self, key: tuple, default: Any = None) -> Any:
+        """Return cached value for `key` (from `file_key()`), or `default`."""
+        path = self._cache_path(key[0])
+        try:
+            with path.open("rb") as fp:
+                version, cached_key, value = pickle.load(fp)
+        except FileNotFoundError:
+            return default
+        except Exception:
+            log.debug("Cannot read cache file %s", path, exc_info=True)
+            return default
+        if version != self.version or cached_key != key:
+            log.debug("Cache %s is stale for %s", path, key[0])
+            return default
+        log.debug("Using cached %s for %s", self.name, key[0])
+        return value
+
+    def set(self, key: tuple, value: Any):
+        """Store `value` for `key` (from `file_key()`)."""
+        path = self._cache_path(key[0])
+        data = pickle.dumps((self.version, key, value), pickle.HIGHEST_PROTOCOL)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(path, data)
+        except OSError:
+            log.warning("Cannot write cache file %s", path, exc_info=True)
+        else:
+            log.debug("Wrote %s cache for %s to %s", self.name, key[0], path)
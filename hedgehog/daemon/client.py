@@ -0,0 +1,49 @@
+"""
+Client side of the hedgehog daemon (`hedgehogd`).
+
+Tools call `call()` on their hot paths. When no daemon is running it returns
+None, and the caller does the work in-process instead.
+"""
+import logging
+import os
+import pathlib
+
+from typing import Any
+
+import hedgehog
+
+json = hedgehog.lazy_import("json")
+socket = hedgehog.lazy_import("socket")
+
+log = logging.getLogger(__name__)
+TIMEOUT = 2.0
+
+
+def socket_path() -> pathlib.Path:
+    return hedgehog.TEMP_DIR / "hedgehogd.sock"
+
+
+def call(command: str, *args) -> Any:
+    """Run `command` with `args` in the daemon and return the result, or None
+    if there is no daemon to talk to.
+
+    Raises hedgehog.Error if the command failed in the daemon.
+    """
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    request = json.dumps({"command": command, "args": args}).encode() + b"\n"
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(TIMEOUT)
+            sock.connect(str(path))
+            sock.sendall(request)
+            with sock.makefile("rb") as fp:
+                reply = json.loads(fp.readline())
+    except (OSError, ValueError):
+        log.debug("No usable daemon at %s", path, exc_info=True)
+        return None
+    log.debug("daemon reply: %s", reply)
+    if "error" in reply:
+        raise hedgehog.Error("%s", reply["error"], retcode=reply.get("retcode", 1))
+    return reply["result"]
@@ -0,0 +1,92 @@
+"""
+hedgehogd - optional resident daemon that keeps dirstack, bookmarks and ansible
+inventories in memory, to serve the `ds`, `cdg` and sshansible completion shell
+hooks without re-reading their files on every call.
+
+When the daemon isn't running, the tools do all work in-process as usual.
+"""
+import logging
+import os
+import signal
+import sys
+
+import hedgehog
+from . import client, server
+from .. import Error, Print
+
+log = None
+
+
+def _init(parser, argv: list, /):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "-d",
+        "--detach",
+        action="store_true",
+        help="Run in background. Does nothing if a daemon is already running.",
+    )
+    group.add_argument("--stop", action="store_true", help="Stop a running daemon.")
+    group.add_argument(
+        "--status", action="store_true", help="Exit 0 if a daemon is running."
+    )
+    args = parser.parse_args(argv)
+    return args
+
+
+def main(*, cli_args: str = None):
+    global log
+    args = hedgehog.init(
+        _init,
+        arguments=cli_args,
+        logger=True,
+        argp_kwargs=dict(description=__doc__),
+    )
+    log = logging.getLogger(args.prog_name)
+    path = client.socket_path()
+
+    if args.stop or args.status:
+        if (pid := client.call("ping")) is None:
+            raise Error("hedgehogd is not running", retcode=3)
+        if args.stop:
+            client.call("shutdown")
+            log.info("Stopped hedgehogd (pid %d)", pid)
+        else:
+            print(f"hedgehogd is running (pid {pid}), socket: {path}")
+        return
+
+    if args.detach and client.call("ping") is not None:
+        log.debug("hedgehogd is already running")
+        return
+    srv = server.Server(path)
+    if args.detach:
+        _daemonize()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    srv.serve()
+
+
+def _daemonize():
+    """Double fork to detach from the terminal. Only the daemon returns."""
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir("/")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+
+def main_wrap():
+    try:
+        main()
+    except Error as exc:
+        Print.instance()(f"Error: {exc}", color="red", file=sys.stderr)
+        sys.exit(exc.retcode)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_wrap()
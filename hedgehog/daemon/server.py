@@ -0,0 +1,215 @@
+"""
+Server side of the hedgehog daemon (`hedgehogd`).
+
+Keeps the dirstack, bookmarks, recently used paths and parsed inventories in
+memory, and serves commands from `client.call()` over a Unix socket. Objects
+are reloaded when their file changes on disk, so tools running in-process
+(without the daemon) can still write the same files.
+"""
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import time
+
+from typing import Any, Callable, List, Optional
+
+import hedgehog
+from . import client
+from .. import cache, Print
+from ..dirstack.dirstack import Dirstack
+from ..fzfdirs import bookmarks, main as fzfdirs_main
+from ..ssh import ansible, complete
+
+log = logging.getLogger(__name__)
+
+
+class State:
+    """In-memory objects loaded from files, each one valid for as long as
+    `cache.file_key()` of its file is unchanged."""
+
+    # Bookmarks with globs depend on more than the bookmarks file, so reload
+    # them after this many seconds anyway.
+    BOOKMARKS_MAX_AGE = 60
+
+    def __init__(self):
+        self._objects = {}
+
+    def _load(
+        self,
+        kind: str,
+        path: pathlib.Path,
+        loader: Callable[[pathlib.Path], Any],
+        max_age: Optional[float] = None,
+    ) -> Any:
+        try:
+            key = cache.file_key(path)
+        except OSError:
+            key = None
+        try:
+            cached_key, loaded, obj = self._objects[kind, str(path)]
+        except KeyError:
+            pass
+        else:
+            if cached_key == key and (
+                max_age is None or time.monotonic() - loaded < max_age
+            ):
+                return obj
+        log.info("Load %s from %s", kind, path)
+        obj = loader(path)
+        self._objects[kind, str(path)] = (key, time.monotonic(), obj)
+        return obj
+
+    def _saved(self, kind: str, path: pathlib.Path):
+        """Record that the object of `kind` was just written to `path`."""
+        cached_key, loaded, obj = self._objects[kind, str(path)]
+        try:
+            key = cache.file_key(path)
+        except OSError:
+            key = None
+        self._objects[kind, str(path)] = (key, loaded, obj)
+
+    def _dirstack(self) -> Dirstack:
+        return self._load("dirstack", Dirstack.DIRSTACK, Dirstack.load)
+
+    def _recently_used(self) -> bookmarks.RecentlyUsed:
+        return self._load(
+            "recent", fzfdirs_main.RECENTLY_USED_FILE, bookmarks.RecentlyUsed
+        )
+
+    def _bookmarks(self, bookmarks_file: str) -> bookmarks.Bookmarks:
+        return self._load(
+            "bookmarks",
+            pathlib.Path(bookmarks_file),
+            bookmarks.Bookmarks,
+            max_age=self.BOOKMARKS_MAX_AGE,
+        )
+
+    def ping(self):
+        return os.getpid()
+
+    def dirstack_add(self, path: str, max_size: Optional[int], trusted: bool):
+        stack = self._dirstack()
+        stack.max_size = max_size or stack.MAX_SIZE
+        stack.add(path, trusted=trusted)
+        stack.save()
+        self._saved("dirstack", Dirstack.DIRSTACK)
+        return True
+
+    def dirstack_list(self) -> list:
+        return ["{} | {}".format(*entry) for entry in self._dirstack().sorted()]
+
+    def fzfdirs_list(self, bookmarks_file: str, color: bool) -> list:
+        bm = self._bookmarks(bookmarks_file)
+        Print.instance().color = color
+        return list(bm.sorted_formatted(self._recently_used()))
+
+    def fzfdirs_add_recent(
+        self, bookmarks_file: str, path: str, store_paths: Optional[int] = None
+    ) -> bool:
+        if path not in self._bookmarks(bookmarks_file):
+            return False
+        recent = self._recently_used()
+        recent.store_paths = store_paths or recent.STORE_PATHS
+        recent.add(path)
+        self._saved("recent", fzfdirs_main.RECENTLY_USED_FILE)
+        return True
+
+    def sshansible_complete_hosts(
+        self, inventory: List[str], local_inventory: bool, cwd: str, prefix: str = ""
+    ) -> list:
+        paths = inventory or [
+            local_inventory and ansible.find_inventory(cwd) or ansible.ANSIBLE_INVENTORY
+        ]
+        sources = [
+            (path, self._load("inventory", path, ansible.load_inventory_source))
+            for path in ansible.inventory_sources(paths)
+        ]
+        if len(sources) == 1:
+            hosts = sources[0][1]
+        else:
+            hosts = ansible.merge_inventories(sources)
+        return hosts.completion_index().complete(prefix, complete.recent_hosts())
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # Connections are served one at a time, so don't let a client that stalls
+    # hold up others for longer than they wait themselves.
+    timeout = client.TIMEOUT / 2
+
+    def handle(self):
+        try:
+            if not (data := self.rfile.readline()):
+                return
+            reply = self.server.dispatch(data)
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+        except socket.timeout:
+            log.warning("Client timed out, closing connection")
+
+
+class Server(socketserver.UnixStreamServer):
+    """Serve one request per connection, one connection at a time."""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self.state = State()
+        self.stopping = False
+        self.commands = {
+            "ping": self.state.ping,
+            "shutdown": self.stop,
+            "dirstack.add": self.state.dirstack_add,
+            "dirstack.list": self.state.dirstack_list,
+            "fzfdirs.list": self.state.fzfdirs_list,
+            "fzfdirs.add_recent": self.state.fzfdirs_add_recent,
+            "sshansible.complete_hosts": self.state.sshansible_complete_hosts,
+        }
+        self._remove_stale_socket()
+        umask = os.umask(0o077)
+        try:
+            super().__init__(str(self.path), _RequestHandler)
+        finally:
+            os.umask(umask)
+        # Not at info level, since the shell hook starts a daemon in new shells.
+        log.debug("Listening on %s", self.path)
+
+    def _remove_stale_socket(self):
+        if not self.path.exists():
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(str(self.path))
+            except ConnectionRefusedError:
+                log.info("Removing stale socket %s", self.path)
+                self.path.unlink()
+                return
+        raise hedgehog.Error("A daemon is already listening on %s", self.path)
+
+    def dispatch(self, data: bytes) -> dict:
+        try:
+            request = json.loads(data)
+            log.debug("request: %s", request)
+            try:
+                command = self.commands[request["command"]]
+            except KeyError:
+                raise hedgehog.Error("Unknown command: %s", request["command"])
+            return {"result": command(*request.get("args", []))}
+        except hedgehog.Error as exc:
+            return {"error": str(exc), "retcode": exc.retcode}
+        except Exception as exc:
+            log.exception("Failed to handle request: %r", data)
+            return {"error": f"hedgehogd: {exc!r}", "retcode": 1}
+
+    def stop(self):
+        self.stopping = True
+
+    def serve(self):
+        """Handle requests until the shutdown command is received."""
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            self.path.unlink(missing_ok=True)
+            log.info("Stopped")
@@ -1,77 +1,328 @@
+import bisect
 import collections
+import contextlib
 import datetime
+import fcntl
 import logging
+import os
 import pathlib
 import pickle
+import queue
+import threading
 
-from typing import Union
+from typing import Iterable, List, Union
 
 import hedgehog
+from .. import cache, frecency
 
-Entry = collections.namedtuple("Entry", "time, path")
+# rank: frecency score on a log2 scale, see Dirstack.
+Entry = collections.namedtuple("Entry", "time, path, visits, rank", defaults=(1, 0.0))
 
 
 class Dirstack:
-    """Stack of directory `Entry`'s with last visited timestamps recorded on file."""
+    """Stack of directory `Entry`'s with last visited timestamps recorded on file,
+    ordered by frecency.
+
+    Each visit adds a score which halves every `HALF_LIFE` seconds. Scores are
+    kept as log2(sum(2 ** (visit_time / HALF_LIFE))), which orders the entries
+    the same way as the decayed scores but doesn't change over time, so the
+    entries can be kept in a sorted index which is only updated on visits.
+    When the stack grows past `max_size`, the lowest ranked entries are removed.
+
+    The file is a journal with one record per line, `+` for a visit and `-` for
+    a removed entry, each with a timestamp and path. `save()` appends the
+    records added since `load()` in a single write, and compacts the journal to
+    one `=` record per entry when it has grown too long. Writers hold a lock on
+    a separate lock file, and compaction re-reads the journal so that records
+    written by other processes since `load()` are kept.
+    """
 
     DIRSTACK = hedgehog.CACHE_DIR / "dirstack.dat"
+    MAX_SIZE = 1000
+    HALF_LIFE = 7 * 24 * 3600
+    # Compact the journal when it has more records than this many per entry...
+    COMPACT_RATIO = 4
+    # ...plus this many.
+    COMPACT_SLACK = 100
 
-    def __init__(self, path):
+    def __init__(self, path, max_size=None):
         self.log = None
+        self.max_size = max_size or self.MAX_SIZE
         self._path = path
         self._stack = {}
+        # (rank, path) for all entries, in ascending order.
+        self._index = []
+        self._pending = []
+        self._records = 0
+        self._migrated = False
 
     @classmethod
-    def load(cls, path=None):
+    def load(cls, path=None, *, max_size=None):
         """Load dirstack from file, or return a new instance."""
         path = path or cls.DIRSTACK
         logger = logging.getLogger(cls.__name__)
-        try:
-            with path.open("rb") as fp:
-                stack = pickle.load(fp)
-        except OSError:
-            logger.debug("Cannot open %s", path, exc_info=True)
-            stack = cls(path=path)
+        stack = cls(path=path, max_size=max_size)
         stack.log = logger
+        stack._read()
+        stack._trim()
         return stack
 
-    def sorted(self):
-        return sorted(self._stack.values(), reverse=True)
+    def _read(self):
+        """Read entries from file into the stack. A file that can't be read
+        is moved away, to start over with an empty stack."""
+        try:
+            data = self._path.read_bytes()
+        except OSError:
+            self.log.debug("Cannot open %s", self._path, exc_info=True)
+            return
+        if not data.startswith(pickle.PROTO):
+            self._replay(data.decode(errors="surrogateescape").splitlines())
+            return
+        try:
+            self._migrate(pickle.loads(data))
+        except Exception:
+            corrupt = self._path.with_name(self._path.name + ".corrupt")
+            self.log.warning(
+                "Cannot read %s, moved it to %s", self._path, corrupt, exc_info=True
+            )
+            self._path.replace(corrupt)
+
+    def _migrate(self, old: "Dirstack"):
+        """Take over entries from a pickled instance of an earlier version."""
+        self.log.info("Migrating %d entries from %s", len(old._stack), self._path)
+        for entry in old._stack.values():
+            rank = entry.time.timestamp() / self.HALF_LIFE
+            self._put(Entry(entry.time, entry.path, 1, rank))
+        self._migrated = True
+
+    def _replay(self, records: Iterable[str]):
+        for line in records:
+            try:
+                self._apply(line)
+            except ValueError:
+                self.log.warning("Skipping malformed record: %r", line)
+                continue
+            self._records += 1
+        self.log.debug("Replayed %d records from %s", self._records, self._path)
+
+    def _apply(self, record: str):
+        """Update the stack from a journal record. Raise ValueError if the
+        record is malformed."""
+        op, timestamp, *fields, path = record.rstrip("\n").split("\t")
+        time = datetime.datetime.fromtimestamp(float(timestamp))
+        path = pathlib.Path(path)
+        if op == "+" and not fields:
+            rank = float(timestamp) / self.HALF_LIFE
+            if entry := self._remove(path):
+                # Records from concurrent writers may not be in time order.
+                time = max(time, entry.time)
+                rank = frecency.log2_add(entry.rank, rank)
+                self._put(Entry(time, path, entry.visits + 1, rank))
+            else:
+                self._put(Entry(time, path, 1, rank))
+        elif op == "=" and len(fields) == 2:
+            self._remove(path)
+            self._put(Entry(time, path, int(fields[0]), float(fields[1])))
+        elif op == "-" and not fields:
+            self._remove(path)
+        else:
+            raise ValueError(f"Unknown record type {op!r}")
+
+    def _put(self, entry: Entry):
+        self._stack[entry.path] = entry
+        bisect.insort(self._index, (entry.rank, entry.path))
+
+    def _remove(self, path: pathlib.Path):
+        """Remove entry for `path` and return it, or return None."""
+        if (entry := self._stack.pop(path, None)) is not None:
+            del self._index[bisect.bisect_left(self._index, (entry.rank, path))]
+        return entry
+
+    def _trim(self):
+        """Remove the lowest ranked entries until the stack fits in max_size."""
+        while len(self._stack) > self.max_size:
+            _, path = self._index[0]
+            self.log.info("Stack is full, removing %s", path)
+            self._pop(path)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Hold an exclusive lock for modifying the file. The lock is taken on
+        a separate file, since the stack file is replaced on compaction."""
+        lockfile = self._path.with_name(self._path.name + ".lock")
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def sorted(self) -> List[Entry]:
+        """Return all entries, highest ranked first."""
+        return self.top(len(self._index))
+
+    def top(self, count: int) -> List[Entry]:
+        """Return the `count` highest ranked entries, highest ranked first."""
+        start = max(len(self._index) - count, 0)
+        return [self._stack[path] for _, path in reversed(self._index[start:])]
+
+    def score(self, entry: Entry, now: datetime.datetime = None) -> float:
+        """Return the frecency score of `entry` at time `now`, where a visit
+        right now scores 1."""
+        now = (now or datetime.datetime.now()).timestamp()
+        return 2 ** (entry.rank - now / self.HALF_LIFE)
 
     @staticmethod
-    def _item_to_stack_key(item: Union[str, pathlib.Path, Entry]) -> pathlib.Path:
+    def _item_to_stack_key(
+        item: Union[str, pathlib.Path, Entry], trusted: bool = False
+    ) -> pathlib.Path:
         if isinstance(item, Entry):
             return item.path
         if isinstance(item, str):
+            if trusted:
+                return pathlib.Path(item)
             return pathlib.Path(item).expanduser().resolve()
         return item
 
+    def _pop(self, path: pathlib.Path) -> Entry:
+        record = f"-\t{datetime.datetime.now().timestamp():.6f}\t{path}\n"
+        entry = self._stack[path]
+        self._apply(record)
+        self._pending.append(record)
+        return entry
+
     def pop(self, item: Union[str, pathlib.Path, Entry]):
-        path = self._item_to_stack_key(item)
-        return self._stack.pop(path)
+        return self._pop(self._item_to_stack_key(item))
 
-    def add(self, item: Union[str, pathlib.Path, Entry]):
-        path = self._item_to_stack_key(item)
+    def add(self, item: Union[str, pathlib.Path, Entry], *, trusted: bool = False):
+        """Add a visit to `item`.
 
-        if not path.is_dir():
+        If `trusted` is set, `item` is known to be an existing, absolute and
+        normalized path, like $PWD in the shell, so don't resolve it or check
+        that it exists, which can be slow on network filesystems.
+        """
+        path = self._item_to_stack_key(item, trusted)
+
+        if not trusted and not path.is_dir():
             self.log.warning("%s doesn't exist, skip adding it", path)
             return
+        if "\n" in str(path) or "\t" in str(path):
+            self.log.warning("Cannot add path with tab or newline: %r", str(path))
+            return
         if entry := self._stack.get(path):
-            self.log.debug("Overwriting entry: %s", entry)
-        self._stack[path] = Entry(datetime.datetime.now(), path)
+            self.log.debug("Updating entry: %s", entry)
+        record = f"+\t{datetime.datetime.now().timestamp():.6f}\t{path}\n"
+        self._apply(record)
+        self._pending.append(record)
+        self._trim()
+
+    def validate(self) -> "Validator":
+        """Start checking in the background that entries still exist."""
+        return Validator(self._stack)
 
     def save(self):
+        """Write changes to file, merged with changes written by others since
+        the stack was loaded."""
+        with self._lock():
+            if (
+                self._migrated
+                or not self._stack
+                or self._records + len(self._pending)
+                > self.COMPACT_RATIO * len(self._stack) + self.COMPACT_SLACK
+            ):
+                self._compact()
+            elif self._pending:
+                self._append()
+
+    def _append(self):
+        data = "".join(self._pending).encode(errors="surrogateescape")
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self._records += len(self._pending)
+        self._pending = []
+        self.log.debug("Appended %d bytes to %s", len(data), self._path)
+
+    def _compact(self):
+        """Re-read the file and apply pending records on top, then replace the
+        file with one record per entry. Must be called with the lock held."""
+        pending = self._pending
+        self._stack = {}
+        self._index = []
+        self._records = 0
+        self._migrated = False
+        self._read()
+        self._replay(pending)
+        self._trim()
+        self._pending = []
         if not self._stack:
             self.log.info("Stack is empty, removing %s", self._path)
             self._path.unlink(missing_ok=True)
+            self._records = 0
             return
-        with self._path.open("wb") as fp:
-            pickle.dump(self, fp)
-        self.log.debug("Wrote stack to %s", self._path)
+        records = [
+            f"=\t{e.time.timestamp():.6f}\t{e.visits}\t{e.rank!r}\t{e.path}\n"
+            for e in self._stack.values()
+        ]
+        data = "".join(records).encode(errors="surrogateescape")
+        cache.atomic_write(self._path, data)
+        self._records = len(records)
+        self.log.debug("Wrote %d entries to %s", len(records), self._path)
 
     def delete(self):
+        with self._lock():
+            self._path.unlink(missing_ok=True)
         self._stack = {}
-        self.save()
+        self._index = []
+        self._pending = []
+        self._records = 0
+        self.log.info("Removed %s", self._path)
 
     def __len__(self):
         return len(self._stack)
+
+
+class Validator:
+    """Check in background threads whether paths are directories, to not hold
+    up the menu on slow filesystems. Results are kept for the lifetime of the
+    instance."""
+
+    WORKERS = 8
+
+    def __init__(self, paths: Iterable[pathlib.Path]):
+        self._paths = set(paths)
+        self._results = {}
+        self._cond = threading.Condition()
+        self._queue = queue.SimpleQueue()
+        for path in self._paths:
+            self._queue.put(path)
+        # Daemon threads, so a hanging filesystem doesn't block exit.
+        for _ in range(self.WORKERS):
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _worker(self):
+        while True:
+            try:
+                path = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            result = path.is_dir()
+            with self._cond:
+                self._results[path] = result
+                self._cond.notify_all()
+
+    def is_dir(self, path: pathlib.Path) -> bool:
+        """Return whether `path` is a directory, wait for the result if it
+        isn't checked yet."""
+        if path not in self._paths:
+            return path.is_dir()
+        with self._cond:
+            self._cond.wait_for(lambda: path in self._results)
+            return self._results[path]
+
+    def missing(self) -> List[pathlib.Path]:
+        """Return paths found not to be directories so far, without waiting."""
+        with self._cond:
+            return [path for path, ok in self._results.items() if not ok]
@@ -5,14 +5,16 @@ with `ds` shell function.
 import argparse
 import functools
 import logging
+import os
 import pathlib
 import sys
 
-from simple_term_menu import TerminalMenu
-
 import hedgehog
 from .dirstack import Dirstack
 from .. import Error, Print
+from ..daemon import client
+
+simple_term_menu = hedgehog.lazy_import("simple_term_menu")
 
 log = None
 EXIT_NOOP = 3
@@ -37,7 +39,15 @@ def _init(parser, argv: list, /):
     parser.add_argument(
         "--list",
         action="store_true",
-        help="List current dirstack entries sorted on access time on stdout.",
+        help="List current dirstack entries sorted on frecency on stdout.",
+    )
+    parser.add_argument(
+        "--max-size",
+        metavar="N",
+        type=int,
+        default=os.getenv("DIRSTACK_SIZE"),
+        help="Max number of entries to keep, the lowest ranked are removed. Uses "
+        f"environment variable DIRSTACK_SIZE if set, else {Dirstack.MAX_SIZE}.",
     )
     parser.add_argument("--dryrun", action="store_true", help=argparse.SUPPRESS)
     args = parser.parse_args(argv)
@@ -56,18 +66,26 @@ def main(*, cli_args: str = None):
     log = logging.getLogger(args.prog_name)
     log.debug(args)
 
-    stack = Dirstack.load()
     if args.add:
-        stack.add(args.add)
-        stack.save()
+        path = os.path.abspath(os.path.expanduser(args.add))
+        # The `ds` shell function passes $PWD, which needs no checking.
+        trusted = args.add == os.environ.get("PWD")
+        if client.call("dirstack.add", path, args.max_size, trusted) is None:
+            stack = Dirstack.load(max_size=args.max_size)
+            stack.add(args.add, trusted=trusted)
+            stack.save()
+        return
+    if args.list:
+        if (lines := client.call("dirstack.list")) is None:
+            lines = ["{} | {}".format(*entry) for entry in Dirstack.load().sorted()]
+        for line in lines:
+            print(line)
         return
+
+    stack = Dirstack.load(max_size=args.max_size)
     if args.delete:
         stack.delete()
         return
-    if args.list:
-        for entry in stack.sorted():
-            print("{} | {}".format(*entry))
-        return
 
     ordered_entries = stack.sorted()
     menu_entries = [
@@ -77,10 +95,12 @@ def main(*, cli_args: str = None):
     options = [
         "[p] pop an entry",
         "[d] delete an entry",
-        "[o] delete entries older than...",
+        "[o] delete entries ranked below...",
         "[l] last visited directory",
     ]
-    menu = functools.partial(TerminalMenu, show_search_hint=True)
+    # Check that entries exist while the menu is shown.
+    validator = stack.validate()
+    menu = functools.partial(simple_term_menu.TerminalMenu, show_search_hint=True)
     main_menu = menu(menu_entries + options)
     index = main_menu.show()
 
@@ -95,10 +115,12 @@ def main(*, cli_args: str = None):
         option = options[opt]
 
         if "last visited directory" in option:
-            # Find first entry in list (sorted by visit time desc) that is not CWD
-            for entry in ordered_entries:
-                if entry.path != pathlib.Path.cwd():
-                    stack.add(entry)
+            # Find most recently visited entry that is not CWD
+            by_time = sorted(ordered_entries, key=lambda e: e.time, reverse=True)
+            for entry in by_time:
+                if entry.path != pathlib.Path.cwd() and validator.is_dir(entry.path):
+                    stack.add(entry, trusted=True)
+                    _remove_missing(stack, validator)
                     print(entry.path)
                     stack.save()
                     return
@@ -106,8 +128,8 @@ def main(*, cli_args: str = None):
                 raise DirstackException("No entry available", retcode=EXIT_NOOP)
 
         kwargs = {}
-        if "older than" in option:
-            kwargs["title"] = "Delete all entries from selected and older:"
+        if "ranked below" in option:
+            kwargs["title"] = "Delete all entries from selected and below:"
 
         # Show menu of directories again, without the options
         selected_entry = menu(menu_entries, **kwargs).show()
@@ -121,7 +143,7 @@ def main(*, cli_args: str = None):
             entry = stack.pop(ordered_entries[selected_entry].path)
             stack.save()
             raise DirstackException(f"Deleted: {entry.path}", retcode=EXIT_DELETED)
-        elif "older than" in option:
+        elif "ranked below" in option:
             popped = []
             for entry in ordered_entries[selected_entry:]:
                 log.info("delete %s", entry)
@@ -133,13 +155,28 @@ def main(*, cli_args: str = None):
         stack.save()
         return
 
+    if not validator.is_dir(entry.path):
+        _remove_missing(stack, validator)
+        stack.save()
+        raise DirstackException(
+            f"Deleted: {entry.path} (doesn't exist)", retcode=EXIT_DELETED
+        )
+
     # re-add selected path entry to stack
-    stack.add(entry)
+    stack.add(entry, trusted=True)
+    _remove_missing(stack, validator)
     stack.save()
 
     print(entry.path)
 
 
+def _remove_missing(stack, validator):
+    """Remove entries which were found not to exist."""
+    for path in validator.missing():
+        log.info("delete missing %s", path)
+        stack.pop(path)
+
+
 def main_wrap():
     try:
         main()
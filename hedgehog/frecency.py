@@ -0,0 +1,15 @@
+"""
+Frecency ranks, shared by dirstack and fzfdirs.
+
+Each use adds a score which halves every half-life. A rank is the total score
+on a log2 scale, log2(sum(2 ** (use_time / half_life))), which orders entries
+the same way as the decayed scores but doesn't change over time.
+"""
+import math
+
+
+def log2_add(a: float, b: float) -> float:
+    """Return log2(2**a + 2**b) without overflow."""
+    if a < b:
+        a, b = b, a
+    return a + math.log2(1 + 2 ** (b - a))
@@ -1,71 +1,135 @@
 import collections.abc
+import concurrent.futures
+import fnmatch
 import functools
 import glob
 import logging
 import os.path
 import pathlib
+import re
+import time
 
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-import yaml
+import hedgehog
+from .. import Print, cache, frecency
 
-from .. import Print
+yaml = hedgehog.lazy_import("yaml")
 
 log = logging.getLogger(__name__)
 HOME = os.path.expanduser("~") + "/"
+_MAGIC = re.compile(r"[*?[]")
+_glob_cache = cache.FileCache("bookmark-globs")
+
+# Max number of glob patterns to expand at a time in stream_formatted().
+DEFAULT_WORKERS = 8
+# Lines per chunk from stream_formatted().
+CHUNK_SIZE = 256
+BOOKMARK_COLOR = "green"
 
 
 class RecentlyUsed:
     """
-    List of recently used paths stored in a cache file.
-    The most recently used path is first in the list.
+    Recently used paths stored in a cache file, ordered by frecency like
+    `Dirstack`: each use adds a score which halves every `HALF_LIFE` seconds,
+    kept as a rank on a log2 scale. At most `store_paths` paths are kept.
+
+    The file has one `rank<TAB>path` line per path and isn't read until the
+    paths are first needed.
     """
 
-    store_paths = 10
+    STORE_PATHS = 10
+    HALF_LIFE = 24 * 3600
 
-    def __init__(self, path):
+    def __init__(self, path, store_paths: int = None):
         self._file = pathlib.Path(path).resolve()
-        self.paths = []
-        if self._file.exists():
-            self.paths = yaml.safe_load(self._file.read_bytes())
-            log.info(
-                "Read %d recently used paths from %s",
-                len(self.paths),
-                self._file,
-            )
-        log.debug("Recent paths: %s", self.paths)
+        self.store_paths = store_paths or self.STORE_PATHS
+        self._ranks: Optional[Dict[str, float]] = None
 
-    def add(self, path):
-        """Add path to top of recently used list and write file."""
+    @property
+    def paths(self) -> List[str]:
+        """Recently used paths, highest ranked first."""
+        ranks = self._load()
+        return sorted(ranks, key=ranks.get, reverse=True)
+
+    def _load(self) -> Dict[str, float]:
+        if self._ranks is not None:
+            return self._ranks
+        self._ranks = {}
+        try:
+            data = self._file.read_text()
+        except FileNotFoundError:
+            self._ranks = self._read_yaml(self._file.with_suffix(".yaml"))
+            return self._ranks
+        except OSError:
+            log.warning("Cannot read %s", self._file, exc_info=True)
+            return self._ranks
+        for line in data.splitlines():
+            try:
+                rank, path = line.split("\t", 1)
+                self._ranks[path] = float(rank)
+            except ValueError:
+                log.warning("Skipping malformed line in %s: %r", self._file, line)
+        log.info("Read %d recently used paths from %s", len(self._ranks), self._file)
+        return self._ranks
+
+    def _read_yaml(self, path: pathlib.Path) -> Dict[str, float]:
+        """Return ranks of the paths in a file of an earlier version, a YAML
+        list with the most recently used path first."""
+        if not path.exists():
+            return {}
+        log.info("Migrating recently used paths from %s", path)
         try:
-            self.paths.remove(path)
-        except ValueError:
-            pass
-        self.paths.insert(0, path)
-        self.paths = self.paths[: self.store_paths]
-        with self._file.open("w") as fp:
-            yaml.dump(self.paths, fp)
-        log.debug("Wrote paths to %s: %s", self._file, self.paths)
+            paths = yaml.safe_load(path.read_bytes()) or []
+        except (OSError, yaml.YAMLError):
+            log.warning("Cannot read %s", path, exc_info=True)
+            return {}
+        now = time.time() / self.HALF_LIFE
+        # Each path scores half of the one before it.
+        return {path: now - i for i, path in enumerate(paths)}
+
+    def add(self, path):
+        """Record a use of path and write file."""
+        ranks = self._load()
+        rank = time.time() / self.HALF_LIFE
+        if path in ranks:
+            rank = frecency.log2_add(ranks.pop(path), rank)
+        ranks[path] = rank
+        self._ranks = {p: ranks[p] for p in self.paths[: self.store_paths]}
+        data = "".join(f"{rank:.6f}\t{p}\n" for p, rank in self._ranks.items())
+        self._file.parent.mkdir(parents=True, exist_ok=True)
+        cache.atomic_write(self._file, data.encode())
+        log.debug("Wrote paths to %s: %s", self._file, list(self._ranks))
 
 
 class Bookmarks(collections.abc.Container):
     def __init__(self, path):
         self._file = pathlib.Path(path).resolve()
-        self._bookmarks: list[Bookmark] = []
+        # Bookmarks by path, each path only once.
+        self._bookmarks: dict[str, Bookmark] = {}
+        self._sorted: Optional[list[str]] = None
         self._read()
 
     def _read(self):
-        if not self._file.exists():
-            return []
-        entries = yaml.safe_load(self._file.read_bytes())
-        for bm in entries:
-            path = os.path.expanduser(bm["path"])
-            if "*" not in path and not os.path.exists(path):
-                log.warning("Bookmark %s doesn't exist, file: %s", bm, self._file)
+        # Cache key is the bookmarks file path only, each pattern is checked on
+        # its own.
+        key = (str(self._file),)
+        globs = _glob_cache.get(key, {})
+        expanded = {}
+        for path, desc in _read_entries(self._file):
+            if not _MAGIC.search(path):
+                if _is_dir(path, self._file):
+                    self._add(path, desc)
                 continue
-            for p in glob.iglob(path):
-                if os.path.isdir(p):
-                    self._bookmarks.append(Bookmark(p, bm.get("desc")))
+            expanded[path] = _expand(path, globs.get(path))
+            for p in expanded[path][1]:
+                self._add(p, desc)
+        if expanded != globs:
+            _glob_cache.set(key, expanded)
+
+    def _add(self, path: str, desc: Optional[str]):
+        if path not in self._bookmarks:
+            self._bookmarks[path] = Bookmark(path, desc)
 
     def __str__(self):
         return "<Bookmarks: size={}, file={}>".format(len(self._bookmarks), self._file)
@@ -75,28 +139,150 @@ class Bookmarks(collections.abc.Container):
 
     def __contains__(self, item):
         if isinstance(item, Bookmark):
-            return item in self._bookmarks
-        return Bookmark(str(item), None) in self._bookmarks
+            item = item.path
+        return str(item) in self._bookmarks
 
     def sorted_formatted(self, recently_used: Optional[RecentlyUsed] = None):
-        bookmarks = sorted(self._bookmarks)
+        """Yield formatted bookmarks sorted by path, with recently used ones
+        first, most recent first. Recent paths that are no longer bookmarks
+        are skipped."""
+        if self._sorted is None:
+            self._sorted = sorted(self._bookmarks)
+        recent = {}
         if recently_used:
-            # Move bookmarks matching recent_paths to temp_bookmarks and
-            # replace it in the original list with None.
-            indexes = {bm.path: index for index, bm in enumerate(bookmarks)}
-            temp_bookmarks = []
-            for path in recently_used.paths:
-                temp_bookmarks.append(bookmarks[indexes[path]])
-                bookmarks[indexes[path]] = None
-            # Construct new list, with recently used bookmarks on top, then the
-            # original list minus the recent ones.
-            bookmarks = temp_bookmarks + [b for b in bookmarks if b]
-        for bm in bookmarks:
-            yield str(bm)
+            recent = dict.fromkeys(
+                path for path in recently_used.paths if path in self._bookmarks
+            )
+        codes = Print.instance().codes(BOOKMARK_COLOR)
+        for path in recent:
+            yield self._bookmarks[path].format(*codes)
+        for path in self._sorted:
+            if path not in recent:
+                yield self._bookmarks[path].format(*codes)
+
+
+def stream_formatted(
+    path, recently_used: Optional[RecentlyUsed] = None, *, workers=DEFAULT_WORKERS
+) -> Iterator[List[str]]:
+    """Yield formatted bookmarks from file `path` in chunks of lines, as soon
+    as they are known: recently used ones first, then bookmarks without
+    wildcards sorted by path, then the matches of each glob pattern, sorted,
+    as soon as its expansion is done. Glob patterns are expanded at most
+    `workers` at a time.
+
+    Unlike `Bookmarks.sorted_formatted()`, glob matches aren't sorted together
+    with other bookmarks."""
+    file = pathlib.Path(path).resolve()
+    static = {}
+    patterns = {}
+    for path, desc in _read_entries(file):
+        (patterns if _MAGIC.search(path) else static).setdefault(path, desc)
+    seen = set()
+    codes = Print.instance().codes(BOOKMARK_COLOR)
+
+    def chunks(bookmarks: Iterable[Tuple[str, Optional[str]]]):
+        lines = []
+        for path, desc in bookmarks:
+            if path not in seen:
+                seen.add(path)
+                lines.append(Bookmark(path, desc).format(*codes))
+                if len(lines) == CHUNK_SIZE:
+                    yield lines
+                    lines = []
+        if lines:
+            yield lines
+
+    recent = []
+    for path in recently_used.paths if recently_used else ():
+        if path in static:
+            recent.append((path, static[path]))
+            continue
+        for pattern, desc in patterns.items():
+            if fnmatch.fnmatchcase(path, pattern):
+                recent.append((path, desc))
+                break
+    yield from chunks((p, desc) for p, desc in recent if os.path.isdir(p))
+    yield from chunks(
+        (p, desc) for p, desc in sorted(static.items()) if _is_dir(p, file)
+    )
+    if not patterns:
+        return
+    key = (str(file),)
+    globs = _glob_cache.get(key, {})
+    expanded = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(patterns))), thread_name_prefix="glob"
+    ) as executor:
+        futures = {
+            executor.submit(_expand, pattern, globs.get(pattern)): pattern
+            for pattern in patterns
+        }
+        for future in concurrent.futures.as_completed(futures):
+            pattern = futures[future]
+            expanded[pattern] = future.result()
+            desc = patterns[pattern]
+            yield from chunks((p, desc) for p in sorted(expanded[pattern][1]))
+    if expanded != globs:
+        _glob_cache.set(key, expanded)
+
+
+def _read_entries(file: pathlib.Path) -> List[Tuple[str, Optional[str]]]:
+    """Return (path, description) of the bookmarks in `file`, with ~ expanded."""
+    if not file.exists():
+        return []
+    entries = yaml.safe_load(file.read_bytes()) or []
+    return [(os.path.expanduser(bm["path"]), bm.get("desc")) for bm in entries]
+
+
+def _is_dir(path: str, file: pathlib.Path) -> bool:
+    if os.path.isdir(path):
+        return True
+    if not os.path.exists(path):
+        log.warning("Bookmark %s doesn't exist, file: %s", path, file)
+    return False
+
+
+def _scanned_dirs(pattern: str) -> List[str]:
+    """Return the directories that are listed to expand glob `pattern`."""
+    parts = pattern.split(os.sep)
+    first = next(i for i, part in enumerate(parts) if _MAGIC.search(part))
+    dirs = []
+    # Directories before the first wildcard are only looked up, not listed.
+    for i in range(first, len(parts)):
+        prefix = os.sep.join(parts[:i]) or os.sep
+        dirs += glob.glob(prefix) if _MAGIC.search(prefix) else [prefix]
+    return dirs
+
+
+def _dir_mtimes(dirs: List[str]) -> Tuple[Tuple[str, Optional[int]], ...]:
+    mtimes = []
+    for path in dirs:
+        try:
+            mtimes.append((path, os.stat(path).st_mtime_ns))
+        except OSError:
+            mtimes.append((path, None))
+    return tuple(mtimes)
+
+
+def _expand(
+    pattern: str, cached: Optional[Tuple[tuple, List[str]]]
+) -> Tuple[tuple, List[str]]:
+    """Return (mtimes, dirs) of glob `pattern`, where mtimes are of the
+    directories listed to expand it. `cached` is returned as is if none of them
+    changed."""
+    if cached and _dir_mtimes([path for path, _ in cached[0]]) == cached[0]:
+        return cached
+    log.debug("Expand bookmark %s", pattern)
+    # Take mtimes before expanding, so a change during expansion makes the
+    # result stale instead of lost.
+    mtimes = _dir_mtimes(_scanned_dirs(pattern))
+    return mtimes, [p for p in glob.iglob(pattern) if os.path.isdir(p)]
 
 
 @functools.total_ordering
 class Bookmark:
+    __slots__ = ("path", "description")
+
     def __init__(self, path: str, desc: Optional[str]):
         self.path = path
         self.description = desc
@@ -107,8 +293,15 @@ class Bookmark:
     def __gt__(self, other):
         return self.path > other.path
 
+    def __hash__(self):
+        return hash(self.path)
+
     def __str__(self):
-        ret = Print.instance().colored(self.path, "green")
+        return self.format(*Print.instance().codes(BOOKMARK_COLOR))
+
+    def format(self, prefix: str = "", suffix: str = "") -> str:
+        """Return bookmark as a line, with the path between `prefix` and
+        `suffix`, like from `Print.codes()`."""
         if self.description is None:
-            return ret
-        return ret + f"\t({self.description})"
+            return f"{prefix}{self.path}{suffix}"
+        return f"{prefix}{self.path}{suffix}\t({self.description})"
@@ -13,12 +13,13 @@ import sys
 import hedgehog
 from . import bookmarks
 from .. import Error, Print
+from ..daemon import client
 
 log = None
 EXIT_NOOP = 3
 EXIT_DELETED = 4
 BOOKMARK_FILE = hedgehog.CONFIG_DIR / "bookmarks.yaml"
-RECENTLY_USED_FILE = hedgehog.CACHE_DIR / "fzfdirs-recent.yaml"
+RECENTLY_USED_FILE = hedgehog.CACHE_DIR / "fzfdirs-recent"
 
 
 class DirsException(Error):
@@ -42,11 +43,26 @@ def _init(parser, argv: list, /):
         metavar="PATH",
         help="Add %(metavar)s to recently used file",
     )
+    parser.add_argument(
+        "--recent-size",
+        metavar="N",
+        type=int,
+        default=os.getenv("FZFDIRS_RECENT_SIZE"),
+        help="Max number of recently used paths to keep, the lowest ranked are "
+        "removed. Uses environment variable FZFDIRS_RECENT_SIZE if set, else "
+        f"{bookmarks.RecentlyUsed.STORE_PATHS}.",
+    )
     parser.add_argument(
         "--bookmark",
         metavar="DIR",
         help="Add bookmark",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print bookmarks as they are found, recently used first, then "
+        "bookmarks without wildcards, then matches of each glob",
+    )
     parser.add_argument("--dryrun", action="store_true", help=argparse.SUPPRESS)
     args = parser.parse_args(argv)
     return args
@@ -64,28 +80,62 @@ def main(*, cli_args: str = None):
     log = logging.getLogger(args.prog_name)
     log.debug(args)
 
-    bm = bookmarks.Bookmarks(args.file)
-    log.info("bookmarks: %s", bm)
-    recent = bookmarks.RecentlyUsed(RECENTLY_USED_FILE)
-
     if args.edit:
         editor = os.environ.get("EDITOR", "vim")
         os.execlp(editor, editor, args.file)
-    elif args.add_recent:
+
+    bookmarks_file = os.path.abspath(args.file)
+    if args.add_recent:
         path = pathlib.Path(args.add_recent)
         if not path.is_absolute():
             path = pathlib.Path.home() / path
+        added = client.call(
+            "fzfdirs.add_recent", bookmarks_file, path.as_posix(), args.recent_size
+        )
+        if added is not None:
+            log.debug("daemon added recent path %s: %s", path, added)
+            return
+        bm = bookmarks.Bookmarks(args.file)
+        log.info("bookmarks: %s", bm)
         if path in bm:
+            recent = bookmarks.RecentlyUsed(RECENTLY_USED_FILE, args.recent_size)
             recent.add(path.as_posix())
         else:
             log.info("%s is not in bookmarks, skip adding to recent paths list", path)
         return
 
-    if not bm:
+    if (lines := client.call("fzfdirs.list", bookmarks_file, args.color)) is None:
+        if args.stream:
+            return stream_bookmarks(args.file)
+        bm = bookmarks.Bookmarks(args.file)
+        log.info("bookmarks: %s", bm)
+        lines = []
+        if bm:
+            lines = bm.sorted_formatted(bookmarks.RecentlyUsed(RECENTLY_USED_FILE))
+    if not lines:
         raise DirsException("There are no bookmarks yet. --edit opens file in editor.")
 
-    for fmt in bm.sorted_formatted(recent):
-        print(fmt)
+    Print.instance().write_lines(lines)
+
+
+def stream_bookmarks(path):
+    """Print bookmarks from file `path` as they are found, a chunk of lines at
+    a time."""
+    found = False
+    chunks = bookmarks.stream_formatted(
+        path, bookmarks.RecentlyUsed(RECENTLY_USED_FILE)
+    )
+    try:
+        for chunk in chunks:
+            Print.instance().write_lines(chunk)
+            found = True
+    except BrokenPipeError:
+        # fzf exited before reading everything.
+        log.debug("Output closed")
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return
+    if not found:
+        raise DirsException("There are no bookmarks yet. --edit opens file in editor.")
 
 
 def main_wrap():
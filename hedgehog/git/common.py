@@ -5,10 +5,11 @@ import subprocess
 
 from typing import Optional
 
-from simple_term_menu import TerminalMenu
-
+import hedgehog
 from .. import Error, Print
 
+simple_term_menu = hedgehog.lazy_import("simple_term_menu")
+
 Branch = collections.namedtuple("Branch", "branch, all, index, is_checked_out")
 
 
@@ -55,7 +56,7 @@ def select_branch(
             preview_size=0.7,
         )
 
-    menu = TerminalMenu(
+    menu = simple_term_menu.TerminalMenu(
         ("|".join(b) for b in branches),
         cycle_cursor=False,
         show_search_hint=True,
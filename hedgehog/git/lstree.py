@@ -36,17 +36,20 @@ def main(*, cli_args: str = None):
     print_tree(filetree)
 
 
-def print_tree(tree, level=0):
+def print_tree(tree):
     printer = Print.instance()
-    if not tree:
-        return
+    printer.write_lines(_tree_lines(tree, printer.codes("blue")))
+
+
+def _tree_lines(tree: dict, dir_codes: tuple, level=0):
     indent = "  " * level
+    prefix, suffix = dir_codes
     for path, subtree in tree.items():
         if subtree:
-            printer("{}{}/".format(indent, path), color="blue")
-            print_tree(subtree, level + 1)
+            yield f"{prefix}{indent}{path}/{suffix}"
+            yield from _tree_lines(subtree, dir_codes, level + 1)
         else:
-            printer("{}{}".format(indent, path))
+            yield f"{indent}{path}"
 
 
 def paths_to_tree(paths) -> dict:
@@ -1,154 +1,594 @@
 import collections
+import errno
 import itertools
 import logging
 import os
 import pathlib
 import re
 import stat
-import tempfile
-import textwrap
-import warnings
 
-from typing import Dict, Iterable, List, Optional
-
-import yaml
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import hedgehog
+from .. import cache
+from .complete import CompletionIndex
+
+hashlib = hedgehog.lazy_import("hashlib")
+shlex = hedgehog.lazy_import("shlex")
+tempfile = hedgehog.lazy_import("tempfile")
+yaml = hedgehog.lazy_import("yaml")
 
 ANSIBLE_INVENTORY = pathlib.Path.home() / "inventory.yaml"
 
-Host = collections.namedtuple("Host", "name, address")
+# port and user are None unless set with ansible_port and ansible_user.
+Host = collections.namedtuple(
+    "Host", "name, address, port, user", defaults=(None, None)
+)
 log = logging.getLogger(__name__)
+_inventory_cache = cache.FileCache("inventory", version=4)
+_inventory_dir_cache = cache.FileCache("inventory-dir")
 
 
-def get_inventory(*, path=None) -> Dict[str, Host]:
+def get_inventory(*, path=None) -> "Inventory":
     """Get all hosts from inventory. If `path` is set to None, default
-    will be used."""
-    hosts = {}
-    if path:
-        path = pathlib.Path(path)
-        log.info("Using inventory: %s", path)
-    else:
-        path = ANSIBLE_INVENTORY
-        log.debug("Using default inventory: %s", path)
+    will be used.
+
+    `path` can also be a list of inventory files and directories, which are
+    merged with `merge_inventories()`. Each file in a directory, in order of
+    name, is an inventory source.
+
+    Each parsed inventory file is cached and reused for as long as that file
+    is unchanged."""
+    if not path:
+        log.debug("Using default inventory: %s", ANSIBLE_INVENTORY)
+        return load_inventory_source(ANSIBLE_INVENTORY)
+    if isinstance(path, (str, os.PathLike)):
+        path = [path]
+    sources = inventory_sources(path)
+    log.info("Using inventory: %s", ", ".join(map(str, sources)))
+    if len(sources) == 1:
+        return load_inventory_source(sources[0])
+    return merge_inventories((p, load_inventory_source(p)) for p in sources)
+
+
+# Files in inventory directories which are not inventories.
+_IGNORE_SUFFIXES = (
+    "~",
+    ".bak",
+    ".cfg",
+    ".md",
+    ".orig",
+    ".py",
+    ".pyc",
+    ".retry",
+    ".rst",
+    ".swp",
+    ".txt",
+)
+
+
+def inventory_sources(paths: Iterable[Union[str, pathlib.Path]]) -> List[pathlib.Path]:
+    """Return inventory files in `paths`, where a directory is replaced with
+    the files in it, in order of name. Subdirectories, like group_vars, and
+    hidden files are skipped."""
+    sources = []
+    for path in map(pathlib.Path, paths):
+        if not path.is_dir():
+            sources.append(path)
+            continue
+        files = [
+            p
+            for p in sorted(path.iterdir())
+            if not p.name.startswith(".")
+            and not p.name.endswith(_IGNORE_SUFFIXES)
+            and p.is_file()
+        ]
+        if not files:
+            raise hedgehog.Error("No inventory files in directory: %s", path)
+        sources += files
+    return sources
+
+
+def load_inventory_source(path: pathlib.Path) -> "Inventory":
+    """Parse a single inventory file, or return it from cache."""
     try:
+        key = cache.file_key(path)
+        if (hosts := _inventory_cache.get(key)) is not None:
+            return hosts
         with path.open() as fp:
             if path.name.endswith(("yaml", "yml")):
-                return _get_inventory_yaml(fp)
-            for line in fp:
-                if match := re.match(r"(^[\w.-]+)\s.*?\bansible_host=(\S+)", line):
-                    if match[1] in hosts:
-                        warnings.warn(f"Duplicate host {match[1]} in inventory")
-                    hosts[match[1]] = Host(*match.groups())
-    except OSError as err:
+                hosts = _get_inventory_yaml(fp)
+            else:
+                hosts = _get_inventory_ini(fp)
+    except (OSError, ValueError, yaml.YAMLError) as err:
         raise hedgehog.Error(f"Failed to read inventory: {err}") from err
+    # Cached along with the hosts.
+    hosts.completion_index()
+    hosts.digest()
+    _inventory_cache.set(key, hosts)
     return hosts
 
 
-def find_inventory() -> Optional[str]:
-    """Look for an Ansible inventory YAML file in CWD and return path to the
-    first file found that looks like an inventory."""
-    path = pathlib.Path(os.getcwd())
+def merge_inventories(
+    sources: Iterable[Tuple[pathlib.Path, "Inventory"]]
+) -> "Inventory":
+    """Merge (path, inventory) pairs into one inventory, where hosts in later
+    sources replace hosts with the same name in earlier ones, with a warning
+    if they differ. Groups are merged. Group variables only apply to hosts in
+    the same source."""
+    sources = list(sources)
+    merged = Inventory()
+    origins = {}
+    groups = {}
+    for source, inventory in sources:
+        for host in inventory.values():
+            if (old := merged.get(host.name)) is not None and old != host:
+                log.warning(
+                    "Host %s in %s replaces the one in %s: %s -> %s",
+                    host.name,
+                    source,
+                    origins[host.name],
+                    old,
+                    host,
+                )
+            merged[host.name] = host
+            origins[host.name] = source
+        for group, names in inventory.groups.items():
+            groups.setdefault(group, {}).update(dict.fromkeys(names))
+    merged.groups = {group: list(names) for group, names in groups.items()}
+    merged._digest = hashlib.sha1(
+        "".join(inventory.digest() for _, inventory in sources).encode()
+    ).hexdigest()
+    return merged
+
+
+def find_inventory(directory: str = None) -> Optional[str]:
+    """Look for an Ansible inventory YAML file in `directory` (default CWD) and
+    return path to the first file found that looks like an inventory.
+
+    Only the first top-level key of each file is read. The result is cached
+    for as long as the mtime of the directory is unchanged, that is until
+    files are added, removed or renamed in it."""
+    if hedgehog._CALLED_FROM_TEST:
+        return None
+    path = pathlib.Path(directory or os.getcwd())
+    try:
+        key = cache.file_key(path)
+    except OSError:
+        log.debug("Cannot stat %s", path, exc_info=True)
+        return None
+    # "" means no inventory was found.
+    if (found := _inventory_dir_cache.get(key)) is not None:
+        return found or None
     yaml_files = sorted(itertools.chain(path.glob("*.yaml"), path.glob("*.yml")))
     log.debug("Looking at possible inventory files: %s", yaml_files)
-    for p in yaml_files:
+    found = next((p.as_posix() for p in yaml_files if _looks_like_inventory(p)), "")
+    _inventory_dir_cache.set(key, found)
+    return found or None
+
+
+def _looks_like_inventory(path: pathlib.Path) -> bool:
+    """Return True if the first top-level key of YAML file `path` is `all`."""
+    loader = getattr(yaml, "CSafeLoader", None) or yaml.SafeLoader
+    try:
+        with path.open() as fp:
+            events = yaml.parse(fp, Loader=loader)
+            for event in events:
+                if not isinstance(
+                    event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)
+                ):
+                    break
+            else:
+                return False
+            if not isinstance(event, yaml.MappingStartEvent):
+                return False
+            event = next(events, None)
+            if isinstance(event, yaml.ScalarEvent) and event.value == "all":
+                log.debug("Looks like an inventory: %s", path)
+                return True
+    except (OSError, UnicodeDecodeError, yaml.YAMLError):
+        log.debug("Couldn't read yaml file %s", path, exc_info=True)
+    return False
+
+
+class Inventory(dict):
+    """Hosts by name, with an index of the hosts in each group."""
+
+    def __init__(self, hosts: Iterable[Host] = (), groups: Dict[str, List[str]] = None):
+        super().__init__((host.name, host) for host in hosts)
+        # Group name: names of hosts in the group or any of its child groups.
+        self.groups = groups or {}
+        self._completion = None
+        self._digest = None
+
+    def completion_index(self) -> CompletionIndex:
+        """Return index of host names for completion, built on first use."""
+        if self._completion is None or len(self._completion) != len(self):
+            self._completion = CompletionIndex(self)
+        return self._completion
+
+    def digest(self) -> str:
+        """Return a digest of the hosts, computed on first use."""
+        if self._digest is None:
+            digest = hashlib.sha1()
+            for host in self.values():
+                digest.update("\t".join(map(str, host)).encode() + b"\n")
+            self._digest = digest.hexdigest()
+        return self._digest
+
+    def group(self, name: str) -> List[Host]:
+        """Return hosts in group `name`, including hosts of child groups."""
+        try:
+            return [self[host] for host in self.groups[name]]
+        except KeyError:
+            raise hedgehog.Error("Couldn't find a group with name: %s", name)
+
+
+class _Group:
+    """A group as read from an inventory file, before inheritance of
+    variables is resolved. A group can be defined in several places, which
+    are merged."""
+
+    __slots__ = ("vars", "hosts", "children")
+
+    def __init__(self):
+        self.vars = {}
+        # Host name: host variables.
+        self.hosts = {}
+        self.children = []
+
+
+# Host variables used by sshansible, others are ignored when reading inventories.
+HOST_VARS = ("ansible_host", "ansible_port", "ansible_user")
+# Compiled on first use by re.match().
+_HOST_RANGE = (
+    r"^(.*?)\[(?:([0-9]+):([0-9]+)|([a-zA-Z]):([a-zA-Z]))(?::([0-9]+))?\](.*)$"
+)
+
+
+def _expand_hosts(pattern: str) -> List[str]:
+    """Expand host ranges like web[01:50] or db-[a:c], with an optional step
+    like [0:10:2], to a list of host names."""
+    if "[" not in pattern or not (match := re.match(_HOST_RANGE, pattern)):
+        return [pattern]
+    head, start, stop, alpha_start, alpha_stop, step, tail = match.groups()
+    step = int(step or 1)
+    if start is not None:
+        width = len(start) if start.startswith("0") else 0
+        items = [f"{i:0{width}d}" for i in range(int(start), int(stop) + 1, step)]
+    else:
+        items = [chr(c) for c in range(ord(alpha_start), ord(alpha_stop) + 1, step)]
+    tails = _expand_hosts(tail)
+    return [head + item + tail for item in items for tail in tails]
+
+
+def _build_inventory(groups: Dict[str, _Group]) -> Inventory:
+    """Resolve inherited variables of hosts and index hosts by group.
+
+    Like Ansible, variables of child groups override those of their parents,
+    groups at the same depth are applied in order of name, and host variables
+    override group variables. Groups without a parent are children of `all`.
+    """
+    groups.setdefault("all", _Group())
+    parents = collections.defaultdict(set)
+    for name, group in groups.items():
+        for child in group.children:
+            parents[child].add(name)
+    for name in groups:
+        if name != "all" and not parents[name]:
+            parents[name].add("all")
+
+    ancestors = {}
+
+    def get_ancestors(name: str, path: tuple = ()) -> set:
+        if name not in ancestors:
+            result = set()
+            for parent in parents[name]:
+                if parent in path:
+                    log.warning("Group %s is a child of itself", parent)
+                    continue
+                result.add(parent)
+                result |= get_ancestors(parent, path + (name,))
+            ancestors[name] = result
+        return ancestors[name]
+
+    def get_depth(name: str, path: tuple = ()) -> int:
+        return max(
+            (get_depth(p, path + (name,)) + 1 for p in parents[name] if p not in path),
+            default=0,
+        )
+
+    depths = {name: get_depth(name) for name in groups}
+    host_groups = {}
+    host_vars = {}
+    for name, group in groups.items():
+        for host, hvars in group.hosts.items():
+            host_groups.setdefault(host, set()).update(
+                {name, "all"}, get_ancestors(name)
+            )
+            host_vars.setdefault(host, {}).update(hvars)
+
+    hosts = []
+    index = {name: [] for name in groups}
+    for host, member_of in host_groups.items():
+        hvars = {}
+        for name in sorted(member_of, key=lambda name: (depths[name], name)):
+            hvars.update(groups[name].vars)
+        hvars.update(host_vars[host])
+        if not (address := hvars.get("ansible_host")):
+            log.debug("Host %s has no ansible_host", host)
+            continue
+        port = hvars.get("ansible_port")
         try:
-            with p.open() as fp:
-                data = yaml.safe_load(fp)
-            inv = data["all"]
-        except Exception:
-            log.debug("Couldn't read yaml file %s", p, exc_info=True)
+            port = int(port) if port is not None else None
+        except ValueError:
+            log.warning("Host %s has invalid ansible_port: %r", host, port)
+            port = None
+        hosts.append(Host(host, str(address), port, hvars.get("ansible_user")))
+        for name in member_of:
+            index[name].append(host)
+    return Inventory(hosts, index)
+
+
+def _split_ini(line: str) -> List[str]:
+    if "'" in line or '"' in line:
+        return shlex.split(line, comments=True)
+    return line.split("#", 1)[0].split()
+
+
+def _get_inventory_ini(file_):
+    groups = collections.defaultdict(_Group)
+    group, section = groups["ungrouped"], "hosts"
+    for line in file_:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line[0] == "[" and line[-1] == "]":
+            name, _, section = line[1:-1].partition(":")
+            group = groups[name]
+            section = section or "hosts"
             continue
+        if section == "hosts":
+            name, *fields = _split_ini(line)
+            hvars = {}
+            for field in fields:
+                key, _, value = field.partition("=")
+                if key in HOST_VARS:
+                    hvars[key] = value
+            for host in _expand_hosts(name):
+                group.hosts.setdefault(host, {}).update(hvars)
+        elif section == "children":
+            name = _split_ini(line)[0]
+            group.children.append(name)
+            groups[name]
+        elif section == "vars":
+            key, _, value = line.partition("=")
+            if (key := key.strip()) in HOST_VARS:
+                value = _split_ini(value)
+                group.vars[key] = value[0] if value else None
         else:
-            log.debug("Looks like an inventory: %r", inv)
-            if not hedgehog._CALLED_FROM_TEST:
-                return p.as_posix()
-    return None
+            log.debug("Ignoring line in section [%s]: %s", section, line)
+    return _build_inventory(groups)
+
+
+def _get_inventory_yaml(file_):
+    """Return hosts and groups from a YAML inventory. Raise ValueError if it
+    has no `all` group."""
+    loader = getattr(yaml, "CSafeLoader", None) or yaml.SafeLoader
+    return _YamlInventoryParser(yaml.parse(file_, Loader=loader)).parse()
+
+
+class _YamlInventoryParser:
+    """Read groups, hosts and the variables in `HOST_VARS` from the event
+    stream of a YAML inventory, without constructing objects for other
+    variables.
 
+    Memory use depends on the number of hosts, not the size of the file.
+    Anchors are supported for variables, host variables and merge keys (<<).
+    """
 
-def _generate_inventory_yaml_hosts(hostgroup):
-    for name, hvars in hostgroup.items():
+    def __init__(self, events: Iterable):
+        self._events = iter(events)
+        # Anchor name: variables of anchored mappings, value of scalars.
+        self._anchors = {}
+        self._groups = collections.defaultdict(_Group)
+
+    def parse(self) -> Inventory:
+        event = self._next()
+        while isinstance(event, (yaml.StreamStartEvent, yaml.DocumentStartEvent)):
+            event = self._next()
+        found = False
+        for key in self._keys(event):
+            if key == "all":
+                found = True
+                self._group("all", self._next())
+            else:
+                self._skip(self._next())
+        if not found:
+            raise ValueError("No 'all' group in inventory")
+        return _build_inventory(self._groups)
+
+    def _next(self):
         try:
-            yield Host(name, hvars["ansible_host"])
-        except KeyError:
-            log.debug("Host %s has no ansible_host key", name)
+            return next(self._events)
+        except StopIteration:
+            raise ValueError("Unexpected end of YAML stream") from None
 
+    def _keys(self, event) -> Iterable[Optional[str]]:
+        """Yield keys of the mapping starting with `event`, the caller must
+        consume the value node after each key. Non-scalar keys are skipped
+        and yielded as None."""
+        if not isinstance(event, yaml.MappingStartEvent):
+            self._skip(event)
+            return
+        while not isinstance(event := self._next(), yaml.MappingEndEvent):
+            if isinstance(event, yaml.ScalarEvent):
+                yield event.value
+            else:
+                self._skip(event)
+                yield None
 
-def _get_inventory_yaml(file_):
-    hosts = {}
-    inventory = yaml.safe_load(file_)
-    for h in _generate_inventory_yaml_hosts(inventory["all"]["hosts"]):
-        hosts[h.name] = h
-    for group in inventory["all"]["children"].values():
-        for h in _generate_inventory_yaml_hosts(group["hosts"]):
-            hosts[h.name] = h
-    return hosts
+    def _skip(self, event):
+        """Consume the node starting with `event`."""
+        if isinstance(event, yaml.MappingStartEvent) and event.anchor:
+            self._vars(event)
+        elif isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth = 1
+            while depth:
+                event = self._next()
+                if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+                    depth += 1
+                elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                    depth -= 1
+        elif isinstance(event, yaml.ScalarEvent) and event.anchor:
+            self._anchors[event.anchor] = event.value
+
+    def _group(self, name: str, event):
+        group = self._groups[name]
+        for key in self._keys(event):
+            value = self._next()
+            if key == "hosts":
+                for host in self._keys(value):
+                    hvars = self._vars(self._next())
+                    for host in _expand_hosts(host) if host is not None else ():
+                        group.hosts.setdefault(host, {}).update(hvars)
+            elif key == "vars":
+                group.vars.update(self._vars(value))
+            elif key == "children":
+                for child in self._keys(value):
+                    if child is None:
+                        self._skip(self._next())
+                        continue
+                    group.children.append(child)
+                    self._group(child, self._next())
+            else:
+                self._skip(value)
+
+    def _vars(self, event) -> dict:
+        """Return variables in `HOST_VARS` from the mapping starting with
+        `event`."""
+        if isinstance(event, yaml.AliasEvent):
+            anchored = self._anchors.get(event.anchor)
+            return dict(anchored) if isinstance(anchored, dict) else {}
+        if not isinstance(event, yaml.MappingStartEvent):
+            self._skip(event)
+            return {}
+        anchor = event.anchor
+        result = {}
+        merged = {}
+        for key in self._keys(event):
+            value = self._next()
+            if key in HOST_VARS and isinstance(value, yaml.ScalarEvent):
+                self._skip(value)
+                if value.value:
+                    result[key] = value.value
+            elif key in HOST_VARS and isinstance(value, yaml.AliasEvent):
+                if isinstance(anchored := self._anchors.get(value.anchor), str):
+                    result[key] = anchored
+            elif key == "<<" and isinstance(value, yaml.SequenceStartEvent):
+                # Earlier mappings in the list take precedence.
+                items = []
+                while not isinstance(item := self._next(), yaml.SequenceEndEvent):
+                    items.append(self._vars(item))
+                for item in reversed(items):
+                    merged.update(item)
+            elif key == "<<":
+                merged.update(self._vars(value))
+            else:
+                self._skip(value)
+        result = {**merged, **result}
+        if anchor:
+            self._anchors[anchor] = result
+        return result
+
+
+def write_ssh_config(
+    ssh_config: pathlib.Path, inventory: Iterable[Host], /, *, force: bool = False
+) -> bool:
+    """Write host aliases for `inventory` to `ssh_config`, unless it was already
+    written from the same hosts. Return True if the file was written.
+
+    The first line of the file records a digest of the hosts, so a changed
+    inventory is detected by reading that line only. The digest of an
+    `Inventory` from `get_inventory()` is cached along with its hosts.
 
+    Connections to a host alias share a master connection, see `control`."""
+    from . import control
 
-def write_ssh_config(ssh_config: pathlib.Path, inventory: Iterable[Host], /):
     path = pathlib.Path(ssh_config).expanduser()
-    lines = []
-    for host in inventory:
-        extra = ""
-        if "el6" in host.name.lower():
-            extra = "PubkeyAcceptedKeyTypes ssh-rsa"
-        lines.append(
-            textwrap.dedent(
-                f"""\
-                Host {host.name}
-                    Hostname {host.address}
-                    User root
-                    {extra}
-                Host {host.name}-tunnel
-                    Hostname {host.address}
-                    User root
-                    LocalForward 13306 localhost:3306
-                    {extra}
-                """
+    if not isinstance(inventory, Inventory):
+        inventory = Inventory(inventory)
+    control_config = control.config()
+    digest = hashlib.sha1(f"{control_config}{inventory.digest()}".encode())
+    header = f"# Generated by sshansible from inventory {digest.hexdigest()}\n"
+    if not force:
+        try:
+            with path.open() as fp:
+                if fp.readline() == header:
+                    log.debug("%s is up to date", path)
+                    return False
+        except OSError:
+            pass
+    with cache.atomic_open(path, "w") as fp:
+        fp.write(header)
+        for host in inventory.values():
+            options = f"    Hostname {host.address}\n    User {host.user or 'root'}\n"
+            if host.port:
+                options += f"    Port {host.port}\n"
+            extra = ""
+            if "el6" in host.name.lower():
+                extra = "    PubkeyAcceptedKeyTypes ssh-rsa\n"
+            fp.write(
+                f"\nHost {host.name}\n"
+                f"{options}"
+                f"{extra}"
+                f"{control_config}"
+                f"Host {host.name}-tunnel\n"
+                f"{options}"
+                "    LocalForward 13306 localhost:3306\n"
+                f"{extra}"
             )
-        )
-    path.write_text("\n".join(lines))
+    log.info("Wrote inventory of %d hosts to %s", len(inventory), path)
+    return True
 
 
 def write_hosts_file(inventory: List[Host], hosts: pathlib.Path, domain: str = None):
-    """Write host/address pairs to /etc/hosts from ansible inventory."""
+    """Write host/address pairs to /etc/hosts from ansible inventory.
+
+    Only the managed block, sorted by host name, is replaced and the file is
+    left alone if the block is unchanged. If `hosts` can't be written, the new
+    contents are written to a temp file instead and its name is returned."""
     delimiters = (
         "# --- hedgehog managed start ---",
         "# --- hedgehog managed end ---",
     )
+    by_name = {h.name: h for h in inventory}
     if domain:
-        our_lines = [f"{h.address} {h.name} {h.name}.{domain}" for h in inventory]
+        our_lines = [
+            f"{h.address} {name} {name}.{domain}" for name, h in sorted(by_name.items())
+        ]
     else:
-        our_lines = [f"{h.address} {h.name}" for h in inventory]
+        our_lines = [f"{h.address} {name}" for name, h in sorted(by_name.items())]
     if not our_lines:
         log.warning("Inventory seems empty, not writing anything.")
         return
 
-    data = hosts.read_text()
-    new = []
-    in_block = False
-    for line in data.splitlines():
-        if line == delimiters[0]:
-            in_block = True
-            new.append(line)
-        elif line == delimiters[1]:
-            in_block = False
-            new += our_lines
-            our_lines = []
-            new.append(line)
-        elif in_block:
-            log.debug("old entry: %s", line)
-        else:
-            new.append(line)
-    assert not in_block
-    assert len(new)
-    if our_lines:
-        new.append(delimiters[0])
-        new += our_lines
-        new.append(delimiters[1])
-    new_data = "\n".join(new) + "\n"
+    lines = hosts.read_text().splitlines()
+    try:
+        start = lines.index(delimiters[0])
+        end = lines.index(delimiters[1], start)
+    except ValueError:
+        if delimiters[0] in lines:
+            raise hedgehog.Error("Managed block in %s has no end line", hosts)
+        lines += [*delimiters]
+        start, end = len(lines) - 2, len(lines) - 1
+    if lines[start + 1 : end] == our_lines:
+        log.debug("%s is up to date", hosts)
+        return None
+    lines[start + 1 : end] = our_lines
+    new_data = "\n".join(lines) + "\n"
     try:
-        hosts.write_text(new_data)
+        _replace_file(hosts, new_data)
     except PermissionError:
         tempfd, tempname = tempfile.mkstemp()
         log.warning(
@@ -161,5 +601,27 @@ def write_hosts_file(inventory: List[Host], hosts: pathlib.Path, domain: str = N
             f.write(new_data)
         return tempname
     else:
-        log.info("Wrote inventory of %d online hosts to %s", len(inventory), hosts)
+        log.info("Wrote inventory of %d online hosts to %s", len(by_name), hosts)
         return None
+
+
+def _replace_file(path: pathlib.Path, data: str):
+    """Replace the contents of `path` with `data`, atomically if possible.
+
+    The file is written in place if it can't be replaced: if it isn't ours,
+    to keep its owner, if it's a bind mount like /etc/hosts in a container,
+    or if only the file and not its directory is writable. Raise
+    PermissionError if it can't be written at all."""
+    st = path.stat()
+    if st.st_uid == os.geteuid():
+        try:
+            with cache.atomic_open(path, "w", perm=stat.S_IMODE(st.st_mode)) as f:
+                f.write(data)
+            return
+        except OSError as err:
+            if err.errno not in (errno.EBUSY, errno.EXDEV, errno.EACCES, errno.EPERM):
+                raise
+            log.debug("Cannot replace %s, writing it in place: %s", path, err)
+    with path.open("r+") as f:
+        f.write(data)
+        f.truncate()
@@ -0,0 +1,97 @@
+"""
+Host name completion for `sshansible --complete-hosts`.
+"""
+import bisect
+import logging
+
+from typing import Iterable, List, Optional
+
+import hedgehog
+from .. import cache
+
+log = logging.getLogger(__name__)
+
+# Number of recently used hosts to remember.
+RECENT_SIZE = 20
+
+
+class CompletionIndex:
+    """Host names sorted case-insensitively, for prefix lookups by bisection."""
+
+    __slots__ = ("_keys", "_names")
+
+    def __init__(self, names: Iterable[str]):
+        pairs = sorted((name.lower(), name) for name in names)
+        self._keys = [key for key, _ in pairs]
+        self._names = [name for _, name in pairs]
+
+    def prefix(self, prefix: str) -> List[str]:
+        """Return names starting with `prefix`, ignoring case, in order."""
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self._keys, prefix)
+        end = bisect.bisect_left(self._keys, prefix + "\U0010ffff", start)
+        return self._names[start:end]
+
+    def fuzzy(self, query: str) -> List[str]:
+        """Return names containing the characters of `query` in order,
+        ignoring case. Names where they are closer together, or start
+        earlier, come first."""
+        query = query.lower()
+        scored = []
+        for key, name in zip(self._keys, self._names):
+            if (score := _fuzzy_score(query, key)) is not None:
+                scored.append((score, name))
+        scored.sort()
+        return [name for _, name in scored]
+
+    def complete(
+        self, prefix: str, recent: Iterable[str] = (), fuzzy: bool = True
+    ) -> List[str]:
+        """Return names starting with `prefix`, or if there are none and
+        `fuzzy` is set, fuzzy matches. Names in `recent` (most recent first)
+        come before others."""
+        matches = self.prefix(prefix)
+        if not matches and fuzzy and prefix:
+            matches = self.fuzzy(prefix)
+        rank = {name: i for i, name in enumerate(recent)}
+        if rank:
+            matches.sort(key=lambda name: rank.get(name, len(rank)))
+        return matches
+
+    def __len__(self):
+        return len(self._names)
+
+
+def _fuzzy_score(query: str, key: str) -> Optional[tuple]:
+    """Return a sort key for `key` if `query` is a subsequence of it, else
+    None. Substrings have no gaps and sort first."""
+    first = pos = key.find(query[0]) if query else 0
+    if pos < 0:
+        return None
+    for char in query[1:]:
+        pos = key.find(char, pos + 1)
+        if pos < 0:
+            return None
+    return (pos - first + 1 - len(query), first, len(key))
+
+
+def _recent_file():
+    return hedgehog.CACHE_DIR / "sshansible_recent_hosts"
+
+
+def recent_hosts() -> List[str]:
+    """Return recently used host names, most recent first."""
+    try:
+        return _recent_file().read_text().splitlines()
+    except OSError:
+        return []
+
+
+def add_recent_host(name: str):
+    """Record that host `name` was just used."""
+    hosts = [name] + [host for host in recent_hosts() if host != name]
+    data = "".join(f"{host}\n" for host in hosts[:RECENT_SIZE])
+    try:
+        cache.atomic_write(_recent_file(), data.encode())
+    except OSError:
+        log.warning("Cannot write %s", _recent_file(), exc_info=True)
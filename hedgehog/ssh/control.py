@@ -0,0 +1,102 @@
+"""
+Connect to inventory hosts with ssh, through shared connections.
+
+ssh, scp and --remote-cmd run through a master connection (ssh ControlMaster)
+to each host, with its socket in `hedgehog.TEMP_DIR`. The master stays open for
+`CONTROL_PERSIST` after last use, so later commands to the same host skip the
+handshake.
+"""
+import concurrent.futures
+import logging
+import pathlib
+import subprocess
+
+from typing import List, Tuple
+
+import hedgehog
+from .ansible import Host
+
+log = logging.getLogger(__name__)
+
+ACTIONS = ("start", "status", "stop")
+CONTROL_PERSIST = "10m"
+DEFAULT_WORKERS = 16
+
+
+def ssh_options(host: Host) -> List[str]:
+    """Return ssh/scp options to connect to `host` at its inventory address."""
+    options = ["-o", f"Hostname={host.address}"]
+    if host.port:
+        options += ["-o", f"Port={host.port}"]
+    if host.user:
+        options += ["-o", f"User={host.user}"]
+    return options
+
+
+def control_dir() -> pathlib.Path:
+    """Return directory of master sockets, created if missing."""
+    path = hedgehog.TEMP_DIR / "ssh-control"
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+def _settings() -> List[Tuple[str, str]]:
+    return [
+        ("ControlMaster", "auto"),
+        # %C, a hash of the connection, keeps the socket path short.
+        ("ControlPath", f"{control_dir()}/%C"),
+        ("ControlPersist", CONTROL_PERSIST),
+    ]
+
+
+def options() -> List[str]:
+    """Return ssh/scp options to use a master connection."""
+    return [arg for key, value in _settings() for arg in ("-o", f"{key}={value}")]
+
+
+def config() -> str:
+    """Return ssh_config lines to use a master connection."""
+    return "".join(f"    {key} {value}\n" for key, value in _settings())
+
+
+def _ssh(host: Host, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["ssh", *ssh_options(host), *options(), "-o", "BatchMode=yes", *args],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+
+
+def start(host: Host) -> bool:
+    """Open a master connection to `host`, unless it's already open. Return
+    True if it's open."""
+    # The master stays in the background after the command, for ControlPersist.
+    proc = _ssh(host, host.name, "true")
+    if proc.returncode != 0:
+        log.warning("Cannot connect to %s: %s", host.name, proc.stderr.strip())
+    return proc.returncode == 0 and check(host)
+
+
+def check(host: Host) -> bool:
+    """Return True if a master connection to `host` is open."""
+    return _ssh(host, "-O", "check", host.name).returncode == 0
+
+
+def stop(host: Host) -> bool:
+    """Close the master connection to `host`. Return True if it was open."""
+    return _ssh(host, "-O", "exit", host.name).returncode == 0
+
+
+def run(
+    action: str, hosts: List[Host], *, workers: int = DEFAULT_WORKERS
+) -> List[Tuple[Host, bool]]:
+    """Run `action` ("start", "status" or "stop") for `hosts` in parallel, and
+    return (host, result) in the order of `hosts`."""
+    func = {"start": start, "status": check, "stop": stop}[action]
+    if not hosts:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(hosts))), thread_name_prefix="control"
+    ) as executor:
+        return list(zip(hosts, executor.map(func, hosts)))
@@ -19,19 +19,17 @@ import argparse
 import logging
 import os
 import pathlib
-import queue
 import subprocess
 import sys
-import threading
-import time
 
 from typing import List
 
-import yaml
-
 import hedgehog
-from . import ansible
+from . import ansible, complete, control, probe, remote
 from .. import Error, Print
+from ..daemon import client
+
+yaml = hedgehog.lazy_import("yaml")
 
 log = None
 
@@ -42,7 +40,13 @@ def _init(parser, argv: list, /):
         default=str(hedgehog.CONFIG_DIR / "ssh.yaml"),
         help="Config file (default: %(default)s)",
     )
-    parser.add_argument("--complete-hosts", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--complete-hosts",
+        nargs="?",
+        const="",
+        metavar="PREFIX",
+        help=argparse.SUPPRESS,
+    )
     parser.add_argument(
         "sshargs",
         nargs="*",
@@ -62,7 +66,14 @@ def _init(parser, argv: list, /):
         "--remote-cmd",
         metavar="FILE",
         help="Execute remote command read from FILE (- to read from stdin), "
-        "on target host",
+        "on target hosts or on hosts in --group",
+    )
+    parser.add_argument(
+        "--master",
+        choices=control.ACTIONS,
+        help="Open, list or close shared connections to target hosts, hosts in "
+        "--group, or all hosts. ssh, scp and --remote-cmd reuse an open connection "
+        f"to a host, which is kept for {control.CONTROL_PERSIST} after last use",
     )
     parser.add_argument(
         "--copy-id", action="store_true", help="Run ssh-copy-id instead of ssh"
@@ -73,12 +84,62 @@ def _init(parser, argv: list, /):
     parser.add_argument(
         "-L", "--list", action="store_true", help="List hosts in inventory"
     )
+    parser.add_argument(
+        "-g",
+        "--group",
+        help="Only hosts in GROUP or its child groups, with --list, "
+        "--hosts-file, --remote-cmd and --master",
+    )
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        help="Max number of hosts to check at a time with --list and --hosts-file "
+        f"(default: {probe.DEFAULT_WORKERS}), or to run --remote-cmd or --master on "
+        f"at a time (default: {remote.DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--deadline",
+        metavar="SECONDS",
+        type=float,
+        default=probe.DEFAULT_DEADLINE,
+        help="Stop waiting for hosts to answer after %(metavar)s with --list and "
+        "--hosts-file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--probe",
+        choices=probe.BACKENDS,
+        default=probe.DEFAULT_BACKEND,
+        help="How to check if hosts are online with --list and --hosts-file: "
+        "ICMP echo, TCP connect to --probe-port, or the ping command. auto uses "
+        "ICMP if the system allows it, else TCP (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--probe-port",
+        metavar="PORT",
+        type=int,
+        default=probe.DEFAULT_PORT,
+        help="TCP port to connect to with --probe tcp (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=probe.DEFAULT_TTL,
+        help="With --list and --hosts-file, use the last known status of hosts. "
+        "Hosts checked more than %(metavar)s ago are checked again in the "
+        "background, for the next time. 0 to check all hosts now (default: "
+        "%(default)s)",
+    )
     parser.add_argument(
         "-i",
         "--inventory",
-        default=os.getenv("ANSIBLE_INVENTORY"),
-        help="Ansible inventory file (yaml or ini). When not specified, use environment"
-        " variable ANSIBLE_INVENTORY if set, else look for yaml inventory in CWD.",
+        action="append",
+        help="Ansible inventory file (yaml or ini) or directory of inventory files. "
+        "Can be given more than once, hosts in later inventories replace hosts with "
+        "the same name in earlier ones. When not specified, use environment variable "
+        "ANSIBLE_INVENTORY (comma separated) if set, else look for yaml inventory in "
+        "CWD.",
     )
     parser.add_argument(
         "--no-local-inventory",
@@ -89,20 +150,30 @@ def _init(parser, argv: list, /):
         "--ssh-config",
         action="store_true",
         help="Re-write host aliases to ssh_config from ansible "
-        "inventory. Normally this is done automatically on each invocation.",
+        "inventory. Normally this is done automatically when the inventory has "
+        "changed.",
     )
     parser.add_argument(
         "--hosts-file", action="store_true", help="Write ansible hosts to /etc/hosts"
     )
     parser.add_argument("--dryrun", "--ip", action="store_true", help=argparse.SUPPRESS)
     args = parser.parse_args(argv)
+    args.inventory = [
+        path
+        for value in args.inventory or [os.getenv("ANSIBLE_INVENTORY", "")]
+        for path in value.split(",")
+        if path
+    ]
     if (
         not (
-            args.complete_hosts
+            args.complete_hosts is not None
             or args.last
             or args.list
             or args.ssh_config
             or args.hosts_file
+            or args.master
+            or args.remote_cmd
+            and args.group
         )
         and not args.sshargs
     ):
@@ -122,25 +193,35 @@ def main(*, cli_args: str = None):
     cprint = Print.instance()
     cache_file = hedgehog.CACHE_DIR / "sshansible_last_host"
     hostname = None
+    if args.complete_hosts is not None and (
+        names := client.call(
+            "sshansible.complete_hosts",
+            [os.path.abspath(path) for path in args.inventory],
+            args.local_inventory,
+            os.getcwd(),
+            args.complete_hosts,
+        )
+    ) is not None:
+        print("\t".join(names))
+        return True
     inventory = ansible.get_inventory(
         path=args.inventory or args.local_inventory and ansible.find_inventory()
     )
 
-    config_file = pathlib.Path(args.config).resolve()
-    config = yaml.safe_load(config_file.read_bytes())
-    append_host_domain_name = config["domain_name"]
+    if args.complete_hosts is not None:
+        names = inventory.completion_index().complete(
+            args.complete_hosts, complete.recent_hosts()
+        )
+        print("\t".join(names))
+        return True
 
     ssh_config = hedgehog.TEMP_DIR / "ssh_config"
-    if inventory and (args.ssh_config or not ssh_config.exists()):
-        log.info("Write inventory of %d hosts to %s", len(inventory), ssh_config)
-        ansible.write_ssh_config(ssh_config, inventory.values())
+    if inventory:
+        ansible.write_ssh_config(ssh_config, inventory, force=args.ssh_config)
     if args.ssh_config:
         return
 
-    if args.complete_hosts:
-        print("\t".join(inventory.keys()))
-        return True
-    elif args.last:
+    if args.last:
         try:
             hostname = cache_file.read_text()
         except OSError:
@@ -148,15 +229,25 @@ def main(*, cli_args: str = None):
         if not args.sshargs:
             args.sshargs.append(hostname)
     elif args.list:
-        list_inventory(inventory, cache_file)
+        list_inventory(
+            _select_hosts(inventory, args), cache_file, **_probe_options(args)
+        )
         return
     elif args.hosts_file:
-        handle_hosts_file(
-            [h for h, online in list_inventory(inventory, cache_file) if online],
-            append_host_domain_name,
+        config_file = pathlib.Path(args.config).resolve()
+        config = yaml.safe_load(config_file.read_bytes())
+        statuses = list_inventory(
+            _select_hosts(inventory, args), cache_file, **_probe_options(args)
         )
+        online_hosts = [host for host, online in statuses if online]
+        handle_hosts_file(online_hosts, config["domain_name"])
         return
 
+    if args.remote_cmd:
+        return run_remote_command(args, inventory, cache_file)
+    if args.master:
+        return handle_master(args, inventory)
+
     if not hostname:
         hostname = args.scp or args.sshargs[-1]
 
@@ -170,12 +261,13 @@ def main(*, cli_args: str = None):
     except KeyError:
         raise Error("Couldn't find a host with name: %s", hostname)
     cache_file.write_text(hostname)
+    complete.add_recent_host(hostname)
 
     command = "scp" if args.scp else "ssh-copy-id" if args.copy_id else "ssh"
-    exec_args = [command, "-o", f"Hostname={host.address}", *args.sshargs]
-
-    if args.remote_cmd:
-        return run_remote_command(args.remote_cmd, hostname, host.address, exec_args)
+    exec_args = [command, *control.ssh_options(host)]
+    if command != "ssh-copy-id":
+        exec_args += control.options()
+    exec_args += args.sshargs
 
     cprint(f"exec: {' '.join(exec_args)}", "yellow", file=sys.stderr)
     sys.stdout.flush()
@@ -185,6 +277,22 @@ def main(*, cli_args: str = None):
         os.execlp(command, *exec_args)
 
 
+def _select_hosts(inventory: ansible.Inventory, args) -> List[ansible.Host]:
+    if args.group:
+        return inventory.group(args.group)
+    return list(inventory.values())
+
+
+def _probe_options(args) -> dict:
+    return dict(
+        backend=args.probe,
+        port=args.probe_port,
+        workers=args.workers or probe.DEFAULT_WORKERS,
+        deadline=args.deadline,
+        ttl=args.cache_ttl,
+    )
+
+
 def handle_hosts_file(inventory: List[ansible.Host], append_domain: str):
     hosts_file = pathlib.Path("/etc/hosts")
     cprint = Print.instance()
@@ -204,32 +312,21 @@ def handle_hosts_file(inventory: List[ansible.Host], append_domain: str):
         )
 
 
-def host_status(task_q, result_q):
-    """Return True if host is online, otherwise False."""
-    host = task_q.get()
-    log.debug("Processing host: %s", host)
-    proc = subprocess.run(
-        ["ping", "-c", "1", "-W", "0.5", "-q", host.address],
-        text=True,
-        capture_output=True,
-    )
-    log.debug("%s returncode: %d", host, proc.returncode)
-    result_q.put((threading.current_thread(), host, proc.returncode == 0))
-    task_q.task_done()
-
-
-def list_inventory(inventory, cache_file):
-    task_q = queue.Queue()
-    threads = []
-    result_q = queue.Queue()
-    for host in inventory.values():
-        t = threading.Thread(target=host_status, args=(task_q, result_q))
-        threads.append(t)
-        task_q.put(host)
-        t.start()
-    maxhostlen = max(len(h.name) for h in inventory.values())
+def list_inventory(
+    hosts: List[ansible.Host],
+    cache_file,
+    *,
+    backend=probe.DEFAULT_BACKEND,
+    port=probe.DEFAULT_PORT,
+    workers=probe.DEFAULT_WORKERS,
+    deadline=probe.DEFAULT_DEADLINE,
+    ttl=probe.DEFAULT_TTL,
+):
+    """Check hosts and print them as they are done, hosts with a cached status
+    first. Return a list of (host, online) tuples."""
+    maxhostlen = max((len(h.name) for h in hosts), default=8)
     print(
-        "Hostname{padding}  Address          Status   URL".format(
+        "Hostname{padding}  Address          Status   Age    URL".format(
             padding=" " * (maxhostlen - 8)
         )
     )
@@ -239,76 +336,109 @@ def list_inventory(inventory, cache_file):
         lasthost = None
 
     cprint = Print.instance()
+    statuses = {
+        True: cprint.colored("{:<7}".format("online"), "green"),
+        False: cprint.colored("{:<7}".format("offline"), "red"),
+        None: cprint.colored("{:<7}".format("unknown"), "yellow"),
+    }
+    host_codes = {False: cprint.codes(None), True: cprint.codes("cyan")}
     result = []
-    # print hosts as soon as they are ready
-    for _ in range(len(threads)):
-        # Get the number of results as we've created threads.
-        thread, host, status = result_q.get(timeout=5)
-        thread.join()
-        result.append((host, status))
-        print(
-            "{0:<{colwidth}}  {1:<15}  {2:<7}  https://{1}".format(
-                cprint.colored(
-                    "{:<{colwidth}}".format(host.name, colwidth=maxhostlen),
-                    "cyan" if lasthost and host.name == lasthost else None,
-                ),
-                host.address,
-                cprint.colored("{:<7}".format("online"), "green")
-                if status
-                else cprint.colored("{:<7}".format("offline"), "red"),
-                colwidth=maxhostlen,
-            )
+    # print hosts as soon as they are ready, since checking them may take a while
+    for host, status, _, age in probe.check_hosts_cached(
+        hosts,
+        ttl=ttl,
+        backend=backend,
+        port=port,
+        workers=workers,
+        deadline=deadline,
+    ):
+        result.append((host, bool(status)))
+        prefix, suffix = host_codes[bool(lasthost) and host.name == lasthost]
+        cprint.write_lines(
+            [
+                f"{prefix}{host.name:<{maxhostlen}}{suffix}  {host.address:<15}  "
+                f"{statuses[status]:<7}  {_format_age(age):<5}  "
+                f"https://{host.address}"
+            ]
         )
-    assert threading.active_count() == 1
     return result
 
 
-def run_remote_command(remote_cmd_file, hostname, address, exec_args):
-    """Run the script in file remote_cmd_file on the remote host.
-
-    First transfer the file to remote host with scp.
-    Run the file with "sh", then remove the file and print any output.
-    """
-    assert os.path.exists(remote_cmd_file)
-    if remote_cmd_file == "-":
-        log.warning("read from stdin is not implemented")
-        return False
-    remote_tmp_file = "/tmp/sshansible_cmd_{}.sh".format(str(int(time.time())))
-    log.info("Transfer %s to %s:%s", remote_cmd_file, address, remote_tmp_file)
-    proc = subprocess.run(
-        [
-            "scp",
-            "-o",
-            f"Hostname={address}",
-            remote_cmd_file,
-            f"{hostname}:{remote_tmp_file}",
-        ],
-        text=True,
-        check=True,
-        capture_output=True,
-    )
-    log.info("Run %s on %s (%s)", remote_tmp_file, hostname, address)
-    proc = subprocess.run(
-        exec_args
-        + [f"sh {remote_tmp_file}; ret=$?; rm -f {remote_tmp_file}; exit $ret"],
-        text=True,
-        capture_output=True,
+def _format_age(age: float) -> str:
+    """Return age in seconds as a short string, like "42s" or "5m"."""
+    if age is None:
+        return "-"
+    for unit, seconds in (("d", 86400), ("h", 3600), ("m", 60)):
+        if age >= seconds:
+            return f"{age // seconds:.0f}{unit}"
+    return f"{age:.0f}s"
+
+
+def handle_master(args, inventory: ansible.Inventory):
+    """Run control action args.master on the hosts in group args.group, the
+    hosts named in args.sshargs, or else all hosts, and print the result."""
+    if args.group:
+        hosts = inventory.group(args.group)
+    elif args.sshargs:
+        try:
+            hosts = [inventory[name] for name in args.sshargs]
+        except KeyError as err:
+            raise Error("Couldn't find a host with name: %s", err.args[0])
+    else:
+        hosts = list(inventory.values())
+    results = control.run(
+        args.master, hosts, workers=args.workers or control.DEFAULT_WORKERS
     )
     cprint = Print.instance()
-    if proc.stdout:
-        cprint(">>>>> Remote stdout start <<<<<", "yellow")
-        print(proc.stdout)
-        cprint(">>>>> Remote stdout end <<<<<", "yellow")
-    if proc.stderr:
-        cprint(">>>>> Remote stderr start <<<<<", "red")
-        print(proc.stderr)
-        cprint(">>>>> Remote stderr end <<<<<", "red")
-    print(f"Remote exit code: {proc.returncode}")
-    if proc.returncode != 0:
+    statuses = {
+        True: cprint.colored("connected", "green"),
+        False: "-",
+    }
+    if args.master == "stop":
+        statuses[True] = cprint.colored("closed", "yellow")
+    width = max((len(host.name) for host in hosts), default=8)
+    print(f"{'Hostname':<{width}}  Address          Master")
+    for host, result in results:
+        print(f"{host.name:<{width}}  {host.address:<15}  {statuses[result]}")
+
+
+def run_remote_command(args, inventory: ansible.Inventory, cache_file):
+    """Run the script in file args.remote_cmd on the hosts in group args.group,
+    or else on the hosts named last in args.sshargs. Other args.sshargs are
+    passed to ssh.
+
+    Output from all hosts is streamed, prefixed with the host name, and a
+    summary of exit codes is printed at the end."""
+    if args.remote_cmd == "-":
+        script = sys.stdin.buffer.read()
+    else:
+        try:
+            script = pathlib.Path(args.remote_cmd).read_bytes()
+        except OSError as err:
+            raise Error("Cannot read remote command: %s", err)
+    ssh_args = list(args.sshargs)
+    if args.group:
+        hosts = inventory.group(args.group)
+    else:
+        hosts = []
+        while ssh_args and ssh_args[-1] in inventory:
+            hosts.insert(0, inventory[ssh_args.pop()])
+        if not hosts:
+            raise Error("Couldn't find a host with name: %s", args.sshargs[-1])
+        cache_file.write_text(hosts[-1].name)
+    outcomes = remote.run_on_hosts(
+        hosts,
+        script,
+        ssh_args,
+        workers=args.workers or remote.DEFAULT_WORKERS,
+    )
+    remote.print_summary(outcomes)
+    if failed := [o for o in outcomes if o.returncode != 0]:
         raise Error(
-            "Remote command exited with non-zero code: %d",
-            proc.returncode,
-            retcode=proc.returncode,
+            "Remote command failed on %d of %d hosts",
+            len(failed),
+            len(outcomes),
+            retcode=max(o.returncode if (o.returncode or 0) > 0 else 1 for o in failed),
         )
 
 
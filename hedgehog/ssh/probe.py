@@ -0,0 +1,405 @@
+"""
+Check which hosts in an inventory are online.
+
+Backends:
+    ping: run the ping command for each host, from a pool of threads.
+    tcp:  connect to a TCP port (22 by default), from one asyncio event loop.
+          A refused connection also counts as online.
+    icmp: send an ICMP echo request over an unprivileged ICMP datagram socket,
+          from one asyncio event loop. Requires the user's group to be in
+          sysctl net.ipv4.ping_group_range.
+    auto: icmp if available, else tcp.
+"""
+import collections
+import concurrent.futures
+import fcntl
+import itertools
+import logging
+import os
+import pickle
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from typing import Awaitable, Callable, Iterable, Iterator
+
+import hedgehog
+from .. import cache
+from .ansible import Host
+
+asyncio = hedgehog.lazy_import("asyncio")
+
+# online is None if the host didn't answer before the deadline. rtt is the
+# time in seconds it took to get an answer. age is the number of seconds since
+# the host was checked, if the result is from the liveness cache.
+Result = collections.namedtuple("Result", "host, online, rtt, age", defaults=(None,))
+# Last known status of an address, time is a unix timestamp.
+Liveness = collections.namedtuple("Liveness", "online, rtt, time")
+log = logging.getLogger(__name__)
+
+BACKENDS = ("auto", "icmp", "tcp", "ping")
+DEFAULT_BACKEND = "auto"
+DEFAULT_WORKERS = 64
+DEFAULT_DEADLINE = 10.0
+DEFAULT_PORT = 22
+DEFAULT_TTL = 60.0
+# Timeout for each host with the tcp and icmp backends.
+TIMEOUT = 1.0
+_icmp_seq = itertools.count(1)
+
+
+def ping(host: Host) -> bool:
+    """Return True if host answers a single ping."""
+    try:
+        proc = subprocess.run(
+            ["ping", "-c", "1", "-W", "0.5", "-q", host.address],
+            text=True,
+            capture_output=True,
+            timeout=5,
+        )
+    except subprocess.TimeoutExpired:
+        log.debug("%s: ping timed out", host)
+        return False
+    log.debug("%s returncode: %d", host, proc.returncode)
+    return proc.returncode == 0
+
+
+async def tcp_check(host: Host, port: int = DEFAULT_PORT) -> bool:
+    """Return True if host accepts or refuses a TCP connection to port."""
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host.address, port), TIMEOUT
+        )
+    except ConnectionRefusedError:
+        return True
+    except (OSError, asyncio.TimeoutError):
+        log.debug("%s: no TCP connection to port %d", host, port, exc_info=True)
+        return False
+    writer.close()
+    return True
+
+
+def icmp_available() -> bool:
+    """Return True if unprivileged ICMP sockets can be created."""
+    try:
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP).close()
+    except OSError:
+        return False
+    return True
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _icmp_echo_request(icmp_type: int, seq: int, payload: bytes) -> bytes:
+    """Return an ICMP echo request. The identifier is set by the kernel for
+    ICMP datagram sockets."""
+    header = struct.pack("!BBHHH", icmp_type, 0, 0, 0, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack("!BBHHH", icmp_type, 0, checksum, 0, seq) + payload
+
+
+async def icmp_check(host: Host) -> bool:
+    """Return True if host answers an ICMP echo request."""
+    loop = asyncio.get_running_loop()
+    try:
+        (family, _, _, _, sockaddr), *_ = await loop.getaddrinfo(
+            host.address, None, type=socket.SOCK_DGRAM
+        )
+    except OSError:
+        log.debug("%s: cannot resolve address", host, exc_info=True)
+        return False
+    if family == socket.AF_INET6:
+        proto, request_type, reply_type = socket.IPPROTO_ICMPV6, 128, 129
+    else:
+        proto, request_type, reply_type = socket.IPPROTO_ICMP, 8, 0
+    seq = next(_icmp_seq) & 0xFFFF
+    packet = _icmp_echo_request(request_type, seq, os.urandom(8))
+    with socket.socket(family, socket.SOCK_DGRAM, proto) as sock:
+        sock.setblocking(False)
+        end = loop.time() + TIMEOUT
+        try:
+            sock.sendto(packet, sockaddr)
+            while True:
+                data = await asyncio.wait_for(
+                    loop.sock_recv(sock, 1024), max(0, end - loop.time())
+                )
+                if len(data) >= 8:
+                    icmp_type, _, _, _, reply_seq = struct.unpack("!BBHHH", data[:8])
+                    if icmp_type == reply_type and reply_seq == seq:
+                        return True
+        except (OSError, asyncio.TimeoutError):
+            log.debug("%s: no ICMP echo reply", host, exc_info=True)
+            return False
+
+
+def _timed(check: Callable[[Host], bool], host: Host) -> Result:
+    start = time.monotonic()
+    online = check(host)
+    return Result(host, online, time.monotonic() - start)
+
+
+def check_hosts(
+    hosts: Iterable[Host],
+    *,
+    backend: str = DEFAULT_BACKEND,
+    port: int = DEFAULT_PORT,
+    workers: int = DEFAULT_WORKERS,
+    deadline: float = DEFAULT_DEADLINE,
+) -> Iterator[Result]:
+    """Check hosts with the named backend, see `probe_hosts()`."""
+    if backend == "auto":
+        backend = "icmp" if icmp_available() else "tcp"
+    log.debug("Probing hosts with backend %s", backend)
+    if backend == "ping":
+        return probe_hosts(hosts, workers=workers, deadline=deadline)
+    if backend == "tcp":
+        return probe_hosts_async(
+            hosts,
+            workers=workers,
+            deadline=deadline,
+            check=lambda host: tcp_check(host, port),
+        )
+    if backend == "icmp":
+        return probe_hosts_async(
+            hosts, workers=workers, deadline=deadline, check=icmp_check
+        )
+    raise ValueError(f"Unknown probe backend: {backend}")
+
+
+def probe_hosts(
+    hosts: Iterable[Host],
+    *,
+    workers: int = DEFAULT_WORKERS,
+    deadline: float = DEFAULT_DEADLINE,
+    check: Callable[[Host], bool] = None,
+) -> Iterator[Result]:
+    """Check hosts with at most `workers` checks running at a time, and yield
+    a `Result` for each host in the order they finish.
+
+    Hosts that aren't checked within `deadline` seconds are yielded last, with
+    `online` set to None. `check` defaults to `ping()`.
+    """
+    check = check or ping
+    hosts = list(hosts)
+    end = time.monotonic() + deadline
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(hosts))), thread_name_prefix="probe"
+    )
+    futures = {executor.submit(_timed, check, host): host for host in hosts}
+    try:
+        for future in concurrent.futures.as_completed(
+            futures, timeout=max(0, end - time.monotonic())
+        ):
+            host = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception:
+                log.warning("Failed to check %s", host, exc_info=True)
+                result = Result(host, False, None)
+            yield result
+    except concurrent.futures.TimeoutError:
+        log.warning("%d hosts not checked within %.1f seconds", len(futures), deadline)
+        for host in futures.values():
+            yield Result(host, None, None)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def probe_hosts_async(
+    hosts: Iterable[Host],
+    *,
+    workers: int = DEFAULT_WORKERS,
+    deadline: float = DEFAULT_DEADLINE,
+    check: Callable[[Host], Awaitable[bool]],
+) -> Iterator[Result]:
+    """Like `probe_hosts()`, but with `check` as a coroutine function, with
+    all checks run from one event loop in a background thread. `workers`
+    limits the number of open sockets."""
+    hosts = list(hosts)
+    results = queue.SimpleQueue()
+
+    async def check_one(host, semaphore):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                online = await check(host)
+            except Exception:
+                log.warning("Failed to check %s", host, exc_info=True)
+                online = False
+            results.put(Result(host, online, time.monotonic() - start))
+
+    async def check_all():
+        semaphore = asyncio.Semaphore(workers)
+        tasks = [asyncio.ensure_future(check_one(h, semaphore)) for h in hosts]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+
+    # Daemon thread, so a stuck check doesn't hold up exit.
+    threading.Thread(
+        target=asyncio.run, args=(check_all(),), name="probe", daemon=True
+    ).start()
+    end = time.monotonic() + deadline
+    remaining = {host.name: host for host in hosts}
+    while remaining:
+        try:
+            result = results.get(timeout=max(0, end - time.monotonic()))
+        except queue.Empty:
+            log.warning(
+                "%d hosts not checked within %.1f seconds", len(remaining), deadline
+            )
+            break
+        del remaining[result.host.name]
+        yield result
+    for host in remaining.values():
+        yield Result(host, None, None)
+
+
+class LivenessCache:
+    """Last known status of hosts, by address, stored in
+    `hedgehog.CACHE_DIR`."""
+
+    VERSION = 1
+
+    def __init__(self, path=None):
+        self.path = path or hedgehog.CACHE_DIR / "sshansible_liveness.pickle"
+        self._entries = self._read()
+        self._updated = {}
+
+    def _read(self) -> dict:
+        try:
+            with self.path.open("rb") as fp:
+                version, entries = pickle.load(fp)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            log.debug("Cannot read %s", self.path, exc_info=True)
+            return {}
+        return entries if version == self.VERSION else {}
+
+    def get(self, address: str) -> Liveness:
+        return self._updated.get(address) or self._entries.get(address)
+
+    def set(self, address: str, online: bool, rtt: float):
+        self._updated[address] = Liveness(online, rtt, time.time())
+
+    def save(self):
+        """Write entries updated since load, merged with entries written by
+        others since then."""
+        if not self._updated:
+            return
+        entries = self._read()
+        for address, entry in self._updated.items():
+            if address not in entries or entries[address].time < entry.time:
+                entries[address] = entry
+        data = pickle.dumps((self.VERSION, entries), pickle.HIGHEST_PROTOCOL)
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            cache.atomic_write(self.path, data)
+        except OSError:
+            log.warning("Cannot write %s", self.path, exc_info=True)
+            return
+        self._entries = entries
+        self._updated = {}
+        log.debug("Wrote %d entries to %s", len(entries), self.path)
+
+
+def check_hosts_cached(
+    hosts: Iterable[Host], *, ttl: float = DEFAULT_TTL, **options
+) -> Iterator[Result]:
+    """Like `check_hosts()`, but first yield results from the liveness cache,
+    then check hosts which aren't in it while those are printed. The cache is
+    updated with the new results.
+
+    Results older than `ttl` seconds are yielded too, and those hosts are
+    checked again in a background process, so the next call gets fresh
+    results. With `ttl` 0 all hosts are checked now."""
+    liveness = LivenessCache()
+    now = time.time()
+    stale = []
+    missing = []
+    for host in hosts:
+        entry = liveness.get(host.address)
+        if not entry or ttl <= 0:
+            missing.append(host)
+            continue
+        age = max(0, now - entry.time)
+        if age >= ttl:
+            stale.append(host)
+        yield Result(host, entry.online, entry.rtt, age)
+    if stale:
+        log.debug("Refreshing %d hosts older than %ss", len(stale), ttl)
+        _refresh_in_background(liveness.path, stale, options)
+    if not missing:
+        return
+    log.debug("Checking %d hosts not in cache", len(missing))
+    try:
+        for result in check_hosts(missing, **options):
+            if result.online is not None:
+                liveness.set(result.host.address, result.online, result.rtt)
+            yield result
+    finally:
+        liveness.save()
+
+
+def refresh(path, hosts: Iterable[Host], options: dict):
+    """Check `hosts` and store the results in the liveness cache at `path`."""
+    liveness = LivenessCache(path)
+    for result in check_hosts(hosts, **options):
+        if result.online is not None:
+            liveness.set(result.host.address, result.online, result.rtt)
+    liveness.save()
+
+
+def _refresh_in_background(path, hosts: Iterable[Host], options: dict):
+    """Run `refresh()` in a new process, which isn't waited for. Nothing is
+    done if a refresh of the same cache is already running."""
+    lockfile = path.with_name(path.name + ".lock")
+    try:
+        fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        log.warning("Cannot refresh liveness cache", exc_info=True)
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.debug("Liveness cache is already being refreshed")
+            return
+        # The process inherits the lock, which is held until it exits.
+        proc = subprocess.Popen(
+            [sys.executable, "-m", __name__],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            pass_fds=(fd,),
+            start_new_session=True,
+        )
+        with proc.stdin:
+            proc.stdin.write(pickle.dumps((path, list(hosts), options)))
+    except OSError:
+        log.warning("Cannot refresh liveness cache", exc_info=True)
+    else:
+        log.debug("Refreshing liveness cache in process %d", proc.pid)
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    # Results must be pickled with the classes of hedgehog.ssh.probe, not
+    # __main__, for others to read them.
+    from hedgehog.ssh import probe
+
+    probe.refresh(*pickle.load(sys.stdin.buffer))
@@ -0,0 +1,146 @@
+"""
+Run a script on many hosts over ssh, a bounded number of hosts at a time.
+"""
+import collections
+import concurrent.futures
+import logging
+import subprocess
+import sys
+import threading
+
+from typing import IO, List
+
+from .. import Print
+from . import control
+from .ansible import Host
+
+log = logging.getLogger(__name__)
+
+# returncode is None if the script wasn't run, because of an interrupt.
+Outcome = collections.namedtuple("Outcome", "host, returncode")
+
+DEFAULT_WORKERS = 16
+
+
+class PrefixedOutput:
+    """Write lines of output from several hosts as they come, each prefixed
+    with the host name."""
+
+    def __init__(self, hosts: List[Host]):
+        self._width = max((len(host.name) for host in hosts), default=0)
+        self._lock = threading.Lock()
+
+    def write(self, host: Host, line: str, *, stderr: bool = False):
+        cprint = Print.instance()
+        prefix = cprint.colored(
+            f"{host.name:<{self._width}}", "red" if stderr else "cyan"
+        )
+        stream = sys.stderr if stderr else sys.stdout
+        with self._lock:
+            stream.write(f"{prefix} | {line.rstrip()}\n")
+            stream.flush()
+
+    def copy(self, host: Host, fp: IO[bytes], *, stderr: bool = False):
+        """Write lines read from `fp` until EOF."""
+        for line in fp:
+            self.write(host, line.decode(errors="replace"), stderr=stderr)
+
+
+def run_script(
+    host: Host, script: bytes, ssh_args: List[str], output: PrefixedOutput
+) -> int:
+    """Run `script` on `host` by piping it to `sh -s` over a single ssh
+    connection, streaming its output to `output`. Return the exit code.
+
+    Nothing is left on the host if the run is interrupted. The script can't
+    read from stdin, since that is where the script itself comes from."""
+    log.info("Run script on %s (%s)", host.name, host.address)
+    with subprocess.Popen(
+        [
+            "ssh",
+            *control.ssh_options(host),
+            *control.options(),
+            *ssh_args,
+            host.name,
+            "sh -s",
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as proc:
+        threads = [
+            threading.Thread(target=_feed, args=(proc.stdin, script), daemon=True),
+            threading.Thread(
+                target=output.copy,
+                args=(host, proc.stderr),
+                kwargs=dict(stderr=True),
+                daemon=True,
+            ),
+        ]
+        for thread in threads:
+            thread.start()
+        output.copy(host, proc.stdout)
+        for thread in threads:
+            thread.join()
+        return proc.wait()
+
+
+def _feed(fp: IO[bytes], data: bytes):
+    """Write `data` to `fp` and close it, in a thread of its own so a large
+    script doesn't block reading the output."""
+    try:
+        fp.write(data)
+        fp.close()
+    except BrokenPipeError:
+        log.debug("ssh exited before reading the whole script")
+
+
+def run_on_hosts(
+    hosts: List[Host],
+    script: bytes,
+    ssh_args: List[str] = (),
+    *,
+    workers: int = DEFAULT_WORKERS,
+) -> List[Outcome]:
+    """Run `script` on `hosts`, at most `workers` at a time, and return the
+    outcome for each host in the order of `hosts`."""
+    output = PrefixedOutput(hosts)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(hosts))), thread_name_prefix="remote"
+    )
+    futures = [
+        executor.submit(run_script, host, script, list(ssh_args), output)
+        for host in hosts
+    ]
+    try:
+        concurrent.futures.wait(futures)
+    except KeyboardInterrupt:
+        # ssh processes got the SIGINT too.
+        log.warning("Interrupted, waiting for running scripts to stop")
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    outcomes = []
+    for host, future in zip(hosts, futures):
+        try:
+            returncode = future.result()
+        except concurrent.futures.CancelledError:
+            returncode = None
+        except OSError as err:
+            output.write(host, f"Failed to run ssh: {err}", stderr=True)
+            returncode = 255
+        outcomes.append(Outcome(host, returncode))
+    return outcomes
+
+
+def print_summary(outcomes: List[Outcome]):
+    """Print the exit code of the script on each host."""
+    cprint = Print.instance()
+    width = max((len(o.host.name) for o in outcomes), default=0)
+    print(f"{'Hostname':<{width}}  Exit code")
+    for host, returncode in outcomes:
+        if returncode is None:
+            status = cprint.colored("not run", "yellow")
+        else:
+            color = "green" if returncode == 0 else "red"
+            status = cprint.colored(str(returncode), color)
+        print(f"{host.name:<{width}}  {status}")
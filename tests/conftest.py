@@ -20,3 +20,8 @@ def _config_dir(monkeypatch, tmp_path):
 @pytest.fixture(autouse=True)
 def _tempdir(monkeypatch, tmp_path):
     monkeypatch.setattr("tempfile.tempdir", str(tmp_path))
+
+
+@pytest.fixture(autouse=True)
+def _runtime_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(hedgehog, "TEMP_DIR", tmp_path)
@@ -0,0 +1,104 @@
+import os
+import pathlib
+import socket
+import threading
+
+import pytest
+
+import hedgehog
+from hedgehog.daemon import client, server
+from hedgehog.dirstack import dirstack, main as dirstack_main
+from hedgehog.ssh import main as ssh_main
+
+
+@pytest.fixture(autouse=True)
+def dirstack_file(tmp_path, monkeypatch):
+    path = tmp_path / "dirstack.test"
+    monkeypatch.setattr(dirstack.Dirstack, "DIRSTACK", path)
+    return path
+
+
+@pytest.fixture
+def daemon():
+    srv = server.Server(client.socket_path())
+    thread = threading.Thread(target=srv.serve)
+    thread.start()
+    yield srv
+    client.call("shutdown")
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert not client.socket_path().exists()
+
+
+def test_call_without_daemon():
+    assert client.call("ping") is None
+
+
+def test_ping(daemon):
+    assert client.call("ping") == os.getpid()
+    assert client.socket_path().stat().st_mode & 0o077 == 0
+
+
+def test_unknown_command(daemon):
+    with pytest.raises(hedgehog.Error, match="Unknown command: nonexistent"):
+        client.call("nonexistent")
+
+
+def test_stalled_client_times_out(daemon, monkeypatch):
+    monkeypatch.setattr(server._RequestHandler, "timeout", 0.1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stalled:
+        stalled.connect(str(client.socket_path()))
+        stalled.sendall(b'{"command": "pi')
+        assert client.call("ping") == os.getpid()
+
+
+def test_stale_socket_is_replaced():
+    # Socket file left behind by a daemon that died.
+    server.Server(client.socket_path()).server_close()
+    assert client.socket_path().exists()
+    assert client.call("ping") is None
+    srv = server.Server(client.socket_path())
+    srv.server_close()
+
+
+def test_already_running(daemon):
+    with pytest.raises(hedgehog.Error, match="already listening"):
+        server.Server(client.socket_path())
+
+
+def test_dirstack_add_and_list(daemon, dirstack_file, capsys, tmp_path):
+    dirstack_main.main(cli_args=f"--add {tmp_path}")
+    assert [e.visits for e in dirstack.Dirstack.load().sorted()] == [1]
+    # Changes made in-process are picked up by the daemon.
+    stack = dirstack.Dirstack.load()
+    stack.add("/")
+    stack.save()
+    capsys.readouterr()
+    dirstack_main.main(cli_args="--list")
+    out = capsys.readouterr().out.splitlines()
+    assert [pathlib.Path(line.split(" | ")[1]) for line in out] == [
+        pathlib.Path("/"),
+        tmp_path,
+    ]
+
+
+def test_dirstack_add_home(daemon, tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / "foo").mkdir()
+    dirstack_main.main(cli_args="--add '~/foo'")
+    assert [e.path for e in dirstack.Dirstack.load().sorted()] == [tmp_path / "foo"]
+
+
+def test_sshansible_complete_hosts(daemon, tmp_path, capsys):
+    inventory = tmp_path / "inventory.ini"
+    inventory.write_text("host1 ansible_host=192.0.2.1\n")
+    ssh_main.main(cli_args=f"--complete-hosts -i {inventory}")
+    assert capsys.readouterr().out == "host1\n"
+    inventory.write_text("host1 ansible_host=192.0.2.1\nhost2 ansible_host=192.0.2.2\n")
+    ssh_main.main(cli_args=f"--complete-hosts -i {inventory}")
+    assert capsys.readouterr().out == "host1\thost2\n"
+
+
+def test_sshansible_complete_hosts_error(daemon, tmp_path):
+    with pytest.raises(hedgehog.Error, match="Failed to read inventory"):
+        ssh_main.main(cli_args=f"--complete-hosts -i {tmp_path}/missing.ini")
@@ -1,3 +1,7 @@
+import collections
+import datetime
+import logging
+import multiprocessing
 import pathlib
 import pickle
 import pytest
@@ -17,13 +21,31 @@ def testfile(tmp_path, monkeypatch):
 
 @pytest.fixture
 def dirstack_on_disk(testfile, monkeypatch):
-    stack = dirstack.Dirstack(testfile)
-    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
-    stack.add("~/foo/bar")
-    stack.add("relative/dir")
-    stack.add("/etc")
-    with testfile.open("wb") as fp:
-        pickle.dump(stack, fp)
+    """A pickled Dirstack as written by earlier versions, where entries had
+    only time and path, and the stack had no other attributes."""
+    OldEntry = collections.namedtuple("Entry", "time, path")
+    OldEntry.__module__ = dirstack.__name__
+    stack = object.__new__(dirstack.Dirstack)
+    now = datetime.datetime.now()
+    stack.__dict__ = {
+        "log": logging.getLogger("Dirstack"),
+        "_path": testfile,
+        "_stack": {
+            path: OldEntry(now - datetime.timedelta(minutes=i), path)
+            for i, path in enumerate(
+                [
+                    pathlib.Path("/etc"),
+                    pathlib.Path.cwd() / "relative/dir",
+                    pathlib.Path.home() / "foo/bar",
+                ]
+            )
+        },
+    }
+    with monkeypatch.context() as m:
+        # Pickled by reference to the Entry class of the module.
+        m.setattr(dirstack, "Entry", OldEntry)
+        data = pickle.dumps(stack)
+    testfile.write_bytes(data)
     yield testfile
 
 
@@ -72,3 +94,185 @@ def test_dirstack_delete(dirstack_on_disk):
     assert dirstack_on_disk.exists()
     dirstack.Dirstack.load().delete()
     assert not dirstack_on_disk.exists()
+
+
+def test_dirstack_save_appends_records(testfile, monkeypatch):
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    stack = dirstack.Dirstack.load()
+    stack.add("/tmp")
+    stack.add("/etc")
+    stack.save()
+    before = testfile.read_text()
+    assert len(before.splitlines()) == 2
+    stack = dirstack.Dirstack.load()
+    stack.add("/usr")
+    stack.pop("/tmp")
+    stack.save()
+    data = testfile.read_text()
+    assert data.startswith(before)
+    assert [line[0] for line in data.splitlines()] == ["+", "+", "+", "-"]
+    stack = dirstack.Dirstack.load()
+    assert {e.path for e in stack.sorted()} == {
+        pathlib.Path("/etc"),
+        pathlib.Path("/usr"),
+    }
+
+
+def test_dirstack_compaction(testfile, monkeypatch):
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    monkeypatch.setattr(dirstack.Dirstack, "COMPACT_SLACK", 0)
+    for _ in range(5):
+        stack = dirstack.Dirstack.load()
+        stack.add("/tmp")
+        stack.add("/etc")
+        stack.save()
+    assert len(testfile.read_text().splitlines()) <= 2 * dirstack.Dirstack.COMPACT_RATIO
+    assert [e.path for e in dirstack.Dirstack.load().sorted()] == [
+        pathlib.Path("/etc"),
+        pathlib.Path("/tmp"),
+    ]
+
+
+def test_dirstack_migrate_pickle(dirstack_on_disk):
+    stack = dirstack.Dirstack.load()
+    assert [e.path for e in stack.sorted()] == [
+        pathlib.Path("/etc"),
+        pathlib.Path.cwd() / "relative/dir",
+        pathlib.Path.home() / "foo/bar",
+    ]
+    assert all(e.visits == 1 for e in stack.sorted())
+    stack.save()
+    assert dirstack_on_disk.read_text().count("\n") == 3
+    assert [e.path for e in dirstack.Dirstack.load().sorted()] == [
+        e.path for e in stack.sorted()
+    ]
+
+
+def test_dirstack_load_skips_malformed_records(testfile):
+    testfile.write_text("+\t1600000000.0\t/etc\n+\tfoo\t/tmp\n+\t1600000001.0\t/u")
+    stack = dirstack.Dirstack.load()
+    assert [e.path for e in stack.sorted()] == [
+        pathlib.Path("/u"),
+        pathlib.Path("/etc"),
+    ]
+
+
+def test_dirstack_compaction_merges_concurrent_updates(testfile, monkeypatch):
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    monkeypatch.setattr(dirstack.Dirstack, "COMPACT_RATIO", 0)
+    monkeypatch.setattr(dirstack.Dirstack, "COMPACT_SLACK", 0)
+    first = dirstack.Dirstack.load()
+    second = dirstack.Dirstack.load()
+    first.add("/tmp")
+    second.add("/etc")
+    first.save()
+    second.save()
+    assert {e.path for e in dirstack.Dirstack.load().sorted()} == {
+        pathlib.Path("/tmp"),
+        pathlib.Path("/etc"),
+    }
+
+
+def _add_dirs(testfile, dirs):
+    dirstack.Dirstack.COMPACT_SLACK = 2
+    for d in dirs:
+        stack = dirstack.Dirstack.load(testfile)
+        stack.add(d)
+        stack.save()
+
+
+def test_dirstack_concurrent_writers(testfile, tmp_path):
+    dirs = [tmp_path / f"dir{i}" for i in range(40)]
+    for d in dirs:
+        d.mkdir()
+    ctx = multiprocessing.get_context("fork")
+    procs = [
+        ctx.Process(target=_add_dirs, args=(testfile, [str(d) for d in dirs[i::4]]))
+        for i in range(4)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    assert {e.path for e in dirstack.Dirstack.load().sorted()} == set(dirs)
+
+
+def test_dirstack_recover_corrupt_file(testfile, monkeypatch):
+    testfile.write_bytes(pickle.dumps(dirstack.Dirstack(testfile))[:20])
+    stack = dirstack.Dirstack.load()
+    assert len(stack) == 0
+    assert not testfile.exists()
+    assert testfile.with_name(testfile.name + ".corrupt").exists()
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    stack.add("/etc")
+    stack.save()
+    assert [e.path for e in dirstack.Dirstack.load().sorted()] == [pathlib.Path("/etc")]
+
+
+def test_dirstack_frecency_order(testfile, monkeypatch):
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    stack = dirstack.Dirstack.load()
+    for _ in range(3):
+        stack.add("/etc")
+    stack.add("/tmp")
+    assert [(e.path.name, e.visits) for e in stack.sorted()] == [
+        ("etc", 3),
+        ("tmp", 1),
+    ]
+    assert [e.path.name for e in stack.top(1)] == ["etc"]
+    assert stack.top(5) == stack.sorted()
+    etc, tmp = stack.sorted()
+    assert stack.score(etc) == pytest.approx(3, rel=1e-3)
+    later = etc.time + datetime.timedelta(seconds=dirstack.Dirstack.HALF_LIFE)
+    assert stack.score(etc, later) == pytest.approx(1.5, rel=1e-3)
+    stack.save()
+    # Ranks survive compaction.
+    monkeypatch.setattr(dirstack.Dirstack, "COMPACT_RATIO", 0)
+    monkeypatch.setattr(dirstack.Dirstack, "COMPACT_SLACK", 0)
+    stack = dirstack.Dirstack.load()
+    stack.add("/tmp")
+    stack.save()
+    assert testfile.read_text().startswith("=")
+    assert [(e.path.name, e.visits) for e in dirstack.Dirstack.load().sorted()] == [
+        ("etc", 3),
+        ("tmp", 2),
+    ]
+
+
+def test_dirstack_max_size(testfile, monkeypatch):
+    monkeypatch.setattr(pathlib.Path, "is_dir", Mock(return_value=True))
+    stack = dirstack.Dirstack.load(max_size=2)
+    stack.add("/etc")
+    stack.add("/etc")
+    stack.add("/tmp")
+    stack.add("/usr")
+    assert [e.path.name for e in stack.sorted()] == ["etc", "usr"]
+    stack.save()
+    assert len(dirstack.Dirstack.load()) == 2
+    assert [e.path.name for e in dirstack.Dirstack.load(max_size=1).sorted()] == [
+        "etc"
+    ]
+
+
+def test_dirstack_add_trusted(testfile, monkeypatch):
+    mock_is_dir = Mock(return_value=False)
+    mock_resolve = Mock()
+    monkeypatch.setattr(pathlib.Path, "is_dir", mock_is_dir)
+    monkeypatch.setattr(pathlib.Path, "resolve", mock_resolve)
+    stack = dirstack.Dirstack.load()
+    stack.add("/nfs/home/user/work", trusted=True)
+    assert [e.path for e in stack.sorted()] == [pathlib.Path("/nfs/home/user/work")]
+    mock_is_dir.assert_not_called()
+    mock_resolve.assert_not_called()
+
+
+def test_dirstack_validate(tmp_path):
+    exists = tmp_path / "exists"
+    exists.mkdir()
+    missing = tmp_path / "missing"
+    validator = dirstack.Validator([exists, missing])
+    assert validator.is_dir(exists)
+    assert not validator.is_dir(missing)
+    assert validator.missing() == [missing]
+    assert validator.is_dir(tmp_path)
@@ -0,0 +1,162 @@
+import os
+import sys
+import types
+
+import pytest
+
+import hedgehog
+from hedgehog.fzfdirs import bookmarks
+
+
+@pytest.fixture(autouse=True)
+def _cache_dir(tmp_path, monkeypatch):
+    # Keep cache files out of the directories being globbed.
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    monkeypatch.setattr(hedgehog, "CACHE_DIR", cache_dir)
+
+
+@pytest.fixture
+def repos(tmp_path):
+    repos = tmp_path / "repos"
+    for name in ("alpha", "bravo"):
+        (repos / name).mkdir(parents=True)
+    (repos / "README").write_text("not a directory\n")
+    return repos
+
+
+@pytest.fixture
+def bookmarks_file(tmp_path, repos):
+    path = tmp_path / "bookmarks.yaml"
+    path.write_text(f"- path: {repos}/*\n  desc: repo\n- path: {tmp_path}\n")
+    return path
+
+
+def _paths(bm):
+    return sorted(bm._bookmarks)
+
+
+def test_bookmarks_glob(bookmarks_file, repos, tmp_path):
+    bm = bookmarks.Bookmarks(bookmarks_file)
+    assert _paths(bm) == [str(tmp_path), str(repos / "alpha"), str(repos / "bravo")]
+    assert repos / "alpha" in bm
+    assert repos / "README" not in bm
+
+
+def test_bookmarks_glob_cached(bookmarks_file, repos, monkeypatch):
+    expected = _paths(bookmarks.Bookmarks(bookmarks_file))
+
+    def iglob(pattern):
+        raise AssertionError(f"glob not cached: {pattern}")
+
+    monkeypatch.setattr(bookmarks.glob, "iglob", iglob)
+    assert _paths(bookmarks.Bookmarks(bookmarks_file)) == expected
+    monkeypatch.undo()
+
+    # A new directory changes the mtime of the parent directory.
+    (repos / "charlie").mkdir()
+    os.utime(repos, ns=(0, 1))
+    assert str(repos / "charlie") in _paths(bookmarks.Bookmarks(bookmarks_file))
+
+
+def test_bookmarks_nested_glob(tmp_path, repos):
+    path = tmp_path / "bookmarks.yaml"
+    path.write_text(f"- path: {tmp_path}/*/*/src\n")
+    assert _paths(bookmarks.Bookmarks(path)) == []
+    scanned = bookmarks._scanned_dirs(f"{tmp_path}/*/*/src")
+    assert scanned[0] == str(tmp_path)
+    assert str(repos) in scanned
+    assert str(repos / "bravo") in scanned
+    (repos / "bravo" / "src").mkdir()
+    assert _paths(bookmarks.Bookmarks(path)) == [str(repos / "bravo" / "src")]
+
+
+def test_sorted_formatted_recent_first(bookmarks_file, repos, tmp_path, monkeypatch):
+    monkeypatch.setattr(bookmarks.Print.instance(), "color", False)
+    bm = bookmarks.Bookmarks(bookmarks_file)
+    recent = types.SimpleNamespace(
+        paths=[str(repos / "bravo"), "/no/longer/bookmarked", str(repos / "bravo")]
+    )
+    assert list(bm.sorted_formatted(recent)) == [
+        f"{repos}/bravo\t(repo)",
+        str(tmp_path),
+        f"{repos}/alpha\t(repo)",
+    ]
+    assert list(bm.sorted_formatted()) == [
+        str(tmp_path),
+        f"{repos}/alpha\t(repo)",
+        f"{repos}/bravo\t(repo)",
+    ]
+
+
+def test_stream_formatted(tmp_path, repos, monkeypatch):
+    monkeypatch.setattr(bookmarks.Print.instance(), "color", False)
+    (tmp_path / "docs").mkdir()
+    path = tmp_path / "bookmarks.yaml"
+    path.write_text(
+        f"- path: {repos}/*\n  desc: repo\n- path: {tmp_path}/docs\n"
+        f"- path: {tmp_path}/missing\n- path: {repos}/alpha\n"
+    )
+    recent = types.SimpleNamespace(paths=[str(repos / "bravo"), str(tmp_path / "gone")])
+    monkeypatch.setattr(bookmarks, "CHUNK_SIZE", 2)
+    chunks = list(bookmarks.stream_formatted(path, recent))
+    assert chunks == [
+        [f"{repos}/bravo\t(repo)"],
+        [str(tmp_path / "docs"), str(repos / "alpha")],
+    ]
+    # Cached glob matches are the same.
+    assert list(bookmarks.stream_formatted(path, recent)) == chunks
+
+
+def test_main_stream(bookmarks_file, repos, tmp_path, capsys):
+    from hedgehog.fzfdirs import main
+
+    main.main(cli_args=f"--no-color --stream --file {bookmarks_file}")
+    assert capsys.readouterr().out.splitlines() == [
+        str(tmp_path),
+        f"{repos}/alpha\t(repo)",
+        f"{repos}/bravo\t(repo)",
+    ]
+
+
+def test_recently_used(tmp_path, monkeypatch):
+    path = tmp_path / "recent"
+    now = 1_700_000_000.0
+    monkeypatch.setattr(bookmarks.time, "time", lambda: now)
+    recent = bookmarks.RecentlyUsed(path, store_paths=3)
+    for p in ["/a", "/b", "/a", "/c"]:
+        now += 60
+        recent.add(p)
+    # Used twice beats used once, even if less recently.
+    assert recent.paths == ["/a", "/c", "/b"]
+    now += 2 * bookmarks.RecentlyUsed.HALF_LIFE
+    recent.add("/d")
+    assert recent.paths == ["/d", "/a", "/c"]
+    assert not list(tmp_path.glob(".recent.*"))
+    assert bookmarks.RecentlyUsed(path).paths == ["/d", "/a", "/c"]
+
+
+def test_recently_used_lazy(tmp_path, monkeypatch):
+    path = tmp_path / "recent"
+    path.write_text("1.0\t/c\n")
+    recent = bookmarks.RecentlyUsed(path)
+    path.write_text("2.0\t/b\nmalformed\n3.0\t/a\n")
+    assert recent.paths == ["/a", "/b"]
+
+
+def test_recently_used_migrates_yaml(tmp_path):
+    (tmp_path / "recent.yaml").write_text("- /b\n- /a\n")
+    recent = bookmarks.RecentlyUsed(tmp_path / "recent")
+    assert recent.paths == ["/b", "/a"]
+    recent.add("/c")
+    assert (tmp_path / "recent").read_text().count("\n") == 3
+
+
+def test_recently_used_without_yaml(tmp_path, monkeypatch):
+    path = tmp_path / "recent"
+    bookmarks.RecentlyUsed(path).add("/a")
+    monkeypatch.delitem(sys.modules, "yaml", raising=False)
+    recent = bookmarks.RecentlyUsed(path)
+    recent.add("/b")
+    assert set(recent.paths) == {"/a", "/b"}
+    assert "yaml" not in sys.modules
@@ -0,0 +1,9 @@
+import pathlib
+
+from hedgehog.git import lstree
+
+
+def test_print_tree(capsys):
+    paths = ["foo", "bar/a/x", "bar/a/y", "bar/b"]
+    lstree.print_tree(lstree.paths_to_tree(map(pathlib.Path, paths)))
+    assert capsys.readouterr().out == "foo\nbar/\n  a/\n    x\n    y\n  b\n"
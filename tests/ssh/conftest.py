@@ -1,16 +1,13 @@
-import io
 import pytest
 import textwrap
 
-from unittest.mock import MagicMock
-
 from hedgehog.ssh import ansible
 
 
 @pytest.fixture(autouse=True)
-def inventory(monkeypatch):
-    mock_path = MagicMock()
-    inventory = io.StringIO(
+def inventory(monkeypatch, tmp_path):
+    inventory = tmp_path / "inventory.ini"
+    inventory.write_text(
         textwrap.dedent(
             """\
     [localservers]
@@ -21,7 +18,5 @@ def inventory(monkeypatch):
     """
         )
     )
-    mock_path.open.return_value = inventory
-    mock_path.name = "inventory.ini"
-    monkeypatch.setattr(ansible, "ANSIBLE_INVENTORY", mock_path)
+    monkeypatch.setattr(ansible, "ANSIBLE_INVENTORY", inventory)
     return inventory
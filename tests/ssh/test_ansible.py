@@ -1,3 +1,5 @@
+import errno
+import os
 import textwrap
 
 from unittest.mock import MagicMock
@@ -66,23 +68,29 @@ def test_write_ssh_config(tmp_path):
         ansible.Host("golf-el6", "198.51.100.102"),
     ]
     config = tmp_path / "ssh_config"
-    ansible.write_ssh_config(config, inventory)
+    assert ansible.write_ssh_config(config, inventory)
+    control = tmp_path / "ssh-control"
     expected = textwrap.dedent(
-        """\
+        f"""\
+
         Host foxtrot
             Hostname 198.51.100.101
             User root
-
+            ControlMaster auto
+            ControlPath {control}/%C
+            ControlPersist 10m
         Host foxtrot-tunnel
             Hostname 198.51.100.101
             User root
             LocalForward 13306 localhost:3306
 
-
         Host golf-el6
             Hostname 198.51.100.102
             User root
             PubkeyAcceptedKeyTypes ssh-rsa
+            ControlMaster auto
+            ControlPath {control}/%C
+            ControlPersist 10m
         Host golf-el6-tunnel
             Hostname 198.51.100.102
             User root
@@ -90,7 +98,22 @@ def test_write_ssh_config(tmp_path):
             PubkeyAcceptedKeyTypes ssh-rsa
         """
     )
-    assert config.read_text() == expected
+    header, data = config.read_text().split("\n", 1)
+    assert header.startswith("# Generated by sshansible from inventory ")
+    assert data == expected
+    assert control.stat().st_mode & 0o777 == 0o700
+
+
+def test_write_ssh_config_only_when_changed(tmp_path):
+    inventory = [ansible.Host("foxtrot", "198.51.100.101")]
+    config = tmp_path / "ssh_config"
+    assert ansible.write_ssh_config(config, inventory)
+    assert not ansible.write_ssh_config(config, inventory)
+    assert ansible.write_ssh_config(config, inventory, force=True)
+    inventory.append(ansible.Host("golf", "198.51.100.102"))
+    assert ansible.write_ssh_config(config, inventory)
+    assert "Host golf\n" in config.read_text()
+    assert not list(tmp_path.glob(".ssh_config.*"))
 
 
 def test_write_hosts_file_empty_file(tmp_path):
@@ -146,22 +169,26 @@ def test_write_hosts_file_update_existing(tmp_path):
     )
 
 
-def test_write_hosts_file_write_to_tempfile_if_not_root(tmp_path):
+def test_write_hosts_file_write_to_tempfile_if_not_root(tmp_path, monkeypatch):
     inventory = [
-        ansible.Host("foxtrot", "198.51.100.101"),
         ansible.Host("golf", "192.0.2.42"),
+        ansible.Host("foxtrot", "198.51.100.101"),
     ]
-    mock_path = MagicMock()
-    mock_path.read_text.return_value = textwrap.dedent(
-        """\
-        # --- hedgehog managed start ---
-        # --- hedgehog managed end ---
-        127.0.0.1 localhost
-        ::1       localhost
-        """
+    hosts = tmp_path / "hosts"
+    hosts.write_text(
+        textwrap.dedent(
+            """\
+            # --- hedgehog managed start ---
+            # --- hedgehog managed end ---
+            127.0.0.1 localhost
+            ::1       localhost
+            """
+        )
     )
-    mock_path.write_text.side_effect = PermissionError
-    temp = ansible.write_hosts_file(inventory, mock_path)
+    monkeypatch.setattr(
+        ansible, "_replace_file", MagicMock(side_effect=PermissionError)
+    )
+    temp = ansible.write_hosts_file(inventory, hosts)
     with open(temp) as f:
         contents = f.read()
     assert contents == textwrap.dedent(
@@ -174,3 +201,339 @@ def test_write_hosts_file_write_to_tempfile_if_not_root(tmp_path):
         ::1       localhost
         """
     )
+
+
+def test_write_hosts_file_unchanged(tmp_path, monkeypatch):
+    inventory = [
+        ansible.Host("golf", "192.0.2.42"),
+        ansible.Host("foxtrot", "198.51.100.101"),
+        ansible.Host("golf", "192.0.2.42"),
+    ]
+    hosts = tmp_path / "hosts"
+    hosts.write_text("127.0.0.1 localhost\n")
+    hosts.chmod(0o644)
+    assert ansible.write_hosts_file(inventory, hosts) is None
+    assert hosts.read_text().count("golf") == 1
+    assert hosts.stat().st_mode & 0o777 == 0o644
+    # Nothing is written, so no sudo is needed, when the block is unchanged.
+    monkeypatch.setattr(
+        ansible, "_replace_file", MagicMock(side_effect=PermissionError)
+    )
+    assert ansible.write_hosts_file(inventory[::-1], hosts) is None
+
+
+def test_write_hosts_file_bind_mount(tmp_path, monkeypatch):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("127.0.0.1 localhost\n")
+    inode = hosts.stat().st_ino
+
+    def replace(src, dst):
+        raise OSError(errno.EBUSY, "Device or resource busy")
+
+    monkeypatch.setattr("os.replace", replace)
+    inventory = [ansible.Host("golf", "192.0.2.42")]
+    assert ansible.write_hosts_file(inventory, hosts) is None
+    assert "192.0.2.42 golf\n" in hosts.read_text()
+    assert hosts.stat().st_ino == inode
+    assert not list(tmp_path.glob(".hosts.*"))
+
+
+def test_write_hosts_file_unterminated_block(tmp_path):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("# --- hedgehog managed start ---\n192.0.2.42 golf\n")
+    with pytest.raises(hedgehog.Error, match="no end line"):
+        ansible.write_hosts_file([ansible.Host("golf", "192.0.2.42")], hosts)
+
+
+def test_get_inventory_cached(inventory, monkeypatch):
+    hosts = ansible.get_inventory()
+    mock_parse = MagicMock()
+    monkeypatch.setattr(ansible, "_get_inventory_ini", mock_parse)
+    cached = ansible.get_inventory()
+    assert cached == hosts
+    mock_parse.assert_not_called()
+    # The digest of the hosts is cached too.
+    assert cached._digest == hosts.digest()
+    # Changing the inventory invalidates the cache.
+    inventory.write_text("host2 ansible_host=192.0.2.2\n")
+    monkeypatch.undo()
+    monkeypatch.setattr(ansible, "ANSIBLE_INVENTORY", inventory)
+    assert list(ansible.get_inventory()) == ["host2"]
+
+
+def test_get_inventory_yaml(tmp_path):
+    inv = tmp_path / "inventory.yaml"
+    inv.write_text(
+        textwrap.dedent(
+            """\
+            ---
+            all:
+              hosts:
+                alpha:
+                  ansible_host: 192.0.2.10
+              children:
+                group1:
+                  hosts:
+                    bravo:
+                      ansible_host: 192.0.2.11
+                    charlie:
+                      foo: bar
+            """
+        )
+    )
+    hosts = ansible.get_inventory(path=inv)
+    assert hosts == {
+        "alpha": ansible.Host("alpha", "192.0.2.10"),
+        "bravo": ansible.Host("bravo", "192.0.2.11"),
+    }
+    assert ansible.get_inventory(path=inv) == hosts
+
+
+def test_find_inventory__reads_first_key_only(
+    tmp_path, monkeypatch, enable_find_inventory
+):
+    # Both files are invalid YAML after the first key.
+    (tmp_path / "a-ci.yaml").write_text("stages:\n  - build\n bad: [\n")
+    conf = tmp_path / "b-inventory.yaml"
+    conf.write_text("all:\n  hosts:\n bad: [\n")
+    assert ansible.find_inventory(str(tmp_path)) == conf.as_posix()
+
+
+def test_find_inventory__cached_per_directory(
+    tmp_path, monkeypatch, enable_find_inventory
+):
+    # Not tmp_path itself, where cache files are written.
+    project = tmp_path / "project"
+    project.mkdir()
+    conf = project / "inv.yaml"
+    conf.write_text("all:\n  hosts:\n    delta:\n      ansible_host: 192.0.2.12\n")
+    assert ansible.find_inventory(str(project)) == conf.as_posix()
+    detect = MagicMock(return_value=False)
+    monkeypatch.setattr(ansible, "_looks_like_inventory", detect)
+    assert ansible.find_inventory(str(project)) == conf.as_posix()
+    detect.assert_not_called()
+    # Renaming files in the directory changes its mtime.
+    mtime = project.stat().st_mtime_ns
+    conf.rename(project / "inv.yml")
+    os.utime(project, ns=(mtime + 10**9, mtime + 10**9))
+    assert ansible.find_inventory(str(project)) is None
+    detect.assert_called_once_with(project / "inv.yml")
+
+
+def test_get_inventory_yaml_streaming(tmp_path):
+    inv = tmp_path / "inventory.yaml"
+    inv.write_text(
+        textwrap.dedent(
+            """\
+            ---
+            defaults: &defaults
+              ansible_host: 192.0.2.1
+              ansible_user: root
+            all:
+              vars:
+                packages: [a, b, {c: d}]
+              hosts:
+                alpha:
+                  <<: *defaults
+                bravo:
+                  ansible_host: &addr 192.0.2.2
+                  nested: {list: [1, 2, [3]], ansible_host: 192.0.2.99}
+                charlie: *defaults
+                delta:
+                  ansible_host: *addr
+                echo:
+              children:
+                group1:
+                  vars: {ansible_host: 192.0.2.99}
+                  hosts:
+                    foxtrot: {ansible_host: 192.0.2.3}
+                  children:
+                    nested:
+                      hosts:
+                        golf: {ansible_host: 192.0.2.4}
+                group2:
+            """
+        )
+    )
+    assert ansible.get_inventory(path=inv) == {
+        "alpha": ansible.Host("alpha", "192.0.2.1", user="root"),
+        "bravo": ansible.Host("bravo", "192.0.2.2"),
+        "charlie": ansible.Host("charlie", "192.0.2.1", user="root"),
+        "delta": ansible.Host("delta", "192.0.2.2"),
+        "foxtrot": ansible.Host("foxtrot", "192.0.2.3"),
+        "golf": ansible.Host("golf", "192.0.2.4"),
+    }
+
+
+@pytest.mark.parametrize("data", ["", "foo: bar\n", "- all\n", "all: [\n"])
+def test_get_inventory_yaml_invalid(tmp_path, data):
+    inv = tmp_path / "inventory.yaml"
+    inv.write_text(data)
+    with pytest.raises(hedgehog.Error, match="Failed to read inventory"):
+        ansible.get_inventory(path=inv)
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        ("web", ["web"]),
+        ("web[1:3]", ["web1", "web2", "web3"]),
+        ("web[08:10].lan", ["web08.lan", "web09.lan", "web10.lan"]),
+        ("db-[a:c]", ["db-a", "db-b", "db-c"]),
+        ("n[0:6:3]", ["n0", "n3", "n6"]),
+        ("r[1:2]-[a:b]", ["r1-a", "r1-b", "r2-a", "r2-b"]),
+    ],
+)
+def test_expand_hosts(pattern, expected):
+    assert ansible._expand_hosts(pattern) == expected
+
+
+def test_get_inventory_ini_groups(tmp_path):
+    inv = tmp_path / "hosts"
+    inv.write_text(
+        textwrap.dedent(
+            """\
+            # comment
+            bastion ansible_host=192.0.2.1 ansible_user="ops user"
+            nohost foo=bar
+
+            [web]
+            web[1:2] ansible_host=192.0.2.1
+            web3 ansible_host=192.0.2.3 ansible_port=2200  # comment
+
+            [db]
+            db1 ansible_host=192.0.2.10
+
+            [prod:children]
+            web
+            db
+
+            [prod:vars]
+            ansible_user=deploy
+            ansible_port=2222
+
+            [web:vars]
+            ansible_port=8022
+            """
+        )
+    )
+    inventory = ansible.get_inventory(path=inv)
+    assert list(inventory.values()) == [
+        ansible.Host("bastion", "192.0.2.1", None, "ops user"),
+        ansible.Host("web1", "192.0.2.1", 8022, "deploy"),
+        ansible.Host("web2", "192.0.2.1", 8022, "deploy"),
+        ansible.Host("web3", "192.0.2.3", 2200, "deploy"),
+        ansible.Host("db1", "192.0.2.10", 2222, "deploy"),
+    ]
+    assert [h.name for h in inventory.group("prod")] == ["web1", "web2", "web3", "db1"]
+    assert [h.name for h in inventory.group("ungrouped")] == ["bastion"]
+    assert len(inventory.group("all")) == 5
+    with pytest.raises(hedgehog.Error, match="Couldn't find a group"):
+        inventory.group("staging")
+
+
+def test_get_inventory_yaml_nested_groups(tmp_path):
+    inv = tmp_path / "inventory.yml"
+    inv.write_text(
+        textwrap.dedent(
+            """\
+            all:
+              vars:
+                ansible_user: root
+              children:
+                europe:
+                  vars: {ansible_port: 2222}
+                  children:
+                    webservers:
+                      vars: {ansible_user: www}
+                      hosts:
+                        web[01:02]:
+                          ansible_host: 192.0.2.1
+                    databases:
+                      hosts:
+                        db1: {ansible_host: 192.0.2.2, ansible_port: 22}
+                webservers:
+                  hosts:
+                    web03: {ansible_host: 192.0.2.3}
+                empty:
+            """
+        )
+    )
+    inventory = ansible.get_inventory(path=inv)
+    assert inventory == {
+        "web01": ansible.Host("web01", "192.0.2.1", 2222, "www"),
+        "web02": ansible.Host("web02", "192.0.2.1", 2222, "www"),
+        "db1": ansible.Host("db1", "192.0.2.2", 22, "root"),
+        "web03": ansible.Host("web03", "192.0.2.3", 2222, "www"),
+    }
+    assert inventory.groups["webservers"] == ["web01", "web02", "web03"]
+    assert inventory.groups["europe"] == ["web01", "web02", "web03", "db1"]
+    assert inventory.groups["empty"] == []
+    # The index is cached along with the hosts.
+    assert ansible.get_inventory(path=inv).groups == inventory.groups
+
+
+def test_write_ssh_config_port_and_user(tmp_path):
+    config = tmp_path / "ssh_config"
+    ansible.write_ssh_config(config, [ansible.Host("kilo", "192.0.2.1", 2222, "www")])
+    assert "Host kilo\n    Hostname 192.0.2.1\n    User www\n    Port 2222\n" in (
+        config.read_text()
+    )
+
+
+def test_get_inventory_merges_sources(tmp_path, monkeypatch, caplog):
+    envs = tmp_path / "envs"
+    envs.mkdir()
+    (envs / "group_vars").mkdir()
+    (envs / "README.md").write_text("not an inventory")
+    (envs / "a-prod.ini").write_text(
+        "[web]\nweb1 ansible_host=192.0.2.1\nweb2 ansible_host=192.0.2.2\n"
+    )
+    (envs / "b-test.yaml").write_text(
+        "all:\n  children:\n    web:\n      hosts:\n"
+        "        web2: {ansible_host: 192.0.2.22}\n"
+        "        web3: {ansible_host: 192.0.2.3}\n"
+    )
+    extra = tmp_path / "extra.ini"
+    extra.write_text("[db]\ndb1 ansible_host=192.0.2.4\nweb1 ansible_host=192.0.2.1\n")
+
+    inventory = ansible.get_inventory(path=[envs, extra])
+    assert inventory == {
+        "web1": ansible.Host("web1", "192.0.2.1"),
+        "web2": ansible.Host("web2", "192.0.2.22"),
+        "web3": ansible.Host("web3", "192.0.2.3"),
+        "db1": ansible.Host("db1", "192.0.2.4"),
+    }
+    assert inventory.groups["web"] == ["web1", "web2", "web3"]
+    assert inventory.groups["all"] == ["web1", "web2", "web3", "db1"]
+    # Only web2 differs between sources.
+    warnings = [r.getMessage() for r in caplog.records if r.levelname == "WARNING"]
+    assert len(warnings) == 1 and "web2" in warnings[0]
+
+    # Only the changed source is parsed again.
+    extra.write_text("[db]\ndb2 ansible_host=192.0.2.5\n")
+    parse_yaml = MagicMock()
+    monkeypatch.setattr(ansible, "_get_inventory_yaml", parse_yaml)
+    assert "db2" in ansible.get_inventory(path=[envs, extra])
+    parse_yaml.assert_not_called()
+
+
+def test_write_ssh_config_merged_source_changed(tmp_path):
+    first = tmp_path / "a.ini"
+    first.write_text("h1 ansible_host=192.0.2.1\n")
+    second = tmp_path / "b.ini"
+    second.write_text("h2 ansible_host=192.0.2.2\n")
+    config = tmp_path / "ssh_config"
+    assert ansible.write_ssh_config(config, ansible.get_inventory(path=[first, second]))
+    assert not ansible.write_ssh_config(
+        config, ansible.get_inventory(path=[first, second])
+    )
+    second.write_text("h2 ansible_host=192.0.2.2\nh3 ansible_host=192.0.2.3\n")
+    assert ansible.write_ssh_config(config, ansible.get_inventory(path=[first, second]))
+    assert "Host h3\n" in config.read_text()
+
+
+def test_inventory_sources_empty_dir(tmp_path):
+    (tmp_path / "empty").mkdir()
+    with pytest.raises(hedgehog.Error, match="No inventory files"):
+        ansible.inventory_sources([tmp_path / "empty"])
@@ -0,0 +1,38 @@
+from hedgehog.ssh import complete
+
+NAMES = ["web01", "Web02", "db-prod-1", "db-test-1", "webproxy", "mail"]
+
+
+def test_prefix():
+    index = complete.CompletionIndex(NAMES)
+    assert index.prefix("web") == ["web01", "Web02", "webproxy"]
+    assert index.prefix("WEB0") == ["web01", "Web02"]
+    assert index.prefix("") == sorted(NAMES, key=str.lower)
+    assert index.prefix("x") == []
+
+
+def test_fuzzy():
+    index = complete.CompletionIndex(NAMES)
+    # Fewer characters between the matched ones first.
+    assert index.fuzzy("e1") == ["web01", "db-test-1"]
+    assert index.fuzzy("prod") == ["db-prod-1"]
+    assert index.fuzzy("dbt1") == ["db-test-1"]
+    assert index.fuzzy("zz") == []
+
+
+def test_complete():
+    index = complete.CompletionIndex(NAMES)
+    assert index.complete("db") == ["db-prod-1", "db-test-1"]
+    assert index.complete("db", recent=["db-test-1"]) == ["db-test-1", "db-prod-1"]
+    assert index.complete("test") == ["db-test-1"]
+    assert index.complete("test", fuzzy=False) == []
+
+
+def test_recent_hosts():
+    assert complete.recent_hosts() == []
+    for name in ["a", "b", "a", "c"]:
+        complete.add_recent_host(name)
+    assert complete.recent_hosts() == ["c", "a", "b"]
+    for i in range(complete.RECENT_SIZE + 5):
+        complete.add_recent_host(str(i))
+    assert len(complete.recent_hosts()) == complete.RECENT_SIZE
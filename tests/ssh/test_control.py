@@ -0,0 +1,80 @@
+import os
+import textwrap
+
+import pytest
+
+from hedgehog.ssh import ansible, control, main
+
+HOSTS = [ansible.Host("host1", "192.0.2.1"), ansible.Host("down", "192.0.2.2")]
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    """Put ssh on PATH which keeps a marker file per open master connection,
+    and can't connect to host "down"."""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    masters = tmp_path / "masters"
+    masters.mkdir()
+    ssh = bindir / "ssh"
+    ssh.write_text(
+        textwrap.dedent(
+            f"""\
+            #!/bin/sh
+            echo "$@" >> "{tmp_path}/ssh.log"
+            op=
+            for arg; do
+                [ "$prev" = -O ] && op=$arg
+                prev=$arg
+            done
+            case "$op" in
+                check) exec test -e "{masters}/$prev" ;;
+                exit) exec rm "{masters}/$prev" 2>/dev/null ;;
+            esac
+            for arg; do host=$cmd; cmd=$arg; done
+            [ "$host" = down ] && echo "Connection refused" >&2 && exit 255
+            touch "{masters}/$host"
+            """
+        )
+    )
+    ssh.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    return tmp_path
+
+
+def test_options(tmp_path):
+    options = control.options()
+    assert options == [
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={tmp_path}/ssh-control/%C",
+        "-o",
+        "ControlPersist=10m",
+    ]
+
+
+def test_run(fake_ssh):
+    assert control.run("status", HOSTS) == [(HOSTS[0], False), (HOSTS[1], False)]
+    assert control.run("start", HOSTS) == [(HOSTS[0], True), (HOSTS[1], False)]
+    assert control.run("status", HOSTS) == [(HOSTS[0], True), (HOSTS[1], False)]
+    assert control.run("stop", HOSTS) == [(HOSTS[0], True), (HOSTS[1], False)]
+    assert control.run("status", HOSTS[:1]) == [(HOSTS[0], False)]
+    ssh_log = (fake_ssh / "ssh.log").read_text()
+    assert "-o Hostname=192.0.2.1 -o ControlMaster=auto" in ssh_log
+
+
+def test_main_master(fake_ssh, capsys):
+    main.main(cli_args="--no-color --master start host1")
+    main.main(cli_args="--no-color --master status")
+    out = capsys.readouterr().out.splitlines()
+    assert out[-3:] == [
+        "Hostname            Address          Master",
+        "host1               192.0.2.1        connected",
+        "remote.example.com  198.51.100.1     -",
+    ]
+
+
+def test_exec_uses_master(capsys, tmp_path):
+    main.main(cli_args="--dryrun host1")
+    assert f"ControlPath={tmp_path}/ssh-control/" in capsys.readouterr().err
@@ -6,7 +6,7 @@ import textwrap
 from unittest.mock import Mock, sentinel
 
 import hedgehog
-from hedgehog.ssh import main, ansible
+from hedgehog.ssh import main, ansible, control
 
 
 @pytest.fixture
@@ -38,9 +38,22 @@ def config_file(tmp_path):
     )
 
 
-def test_main_complete_hosts(capsys):
+def test_main_complete_hosts(capsys, tmp_path):
     main.main(cli_args="--complete-hosts")
     assert capsys.readouterr().out == "host1\tremote.example.com\n"
+    # Completion doesn't check ssh_config.
+    assert not (tmp_path / "ssh_config").exists()
+    main.main(cli_args="--complete-hosts rem")
+    assert capsys.readouterr().out == "remote.example.com\n"
+    main.main(cli_args="--complete-hosts exmpl")
+    assert capsys.readouterr().out == "remote.example.com\n"
+
+
+def test_main_complete_hosts_recent_first(mock_exec, capsys):
+    main.main(cli_args="remote.example.com")
+    capsys.readouterr()
+    main.main(cli_args="--complete-hosts")
+    assert capsys.readouterr().out == "remote.example.com\thost1\n"
 
 
 def test_main_ssh(mock_exec, cache_file):
@@ -106,3 +119,65 @@ def test_main_ssh_copy_id_to_last(mock_exec):
     assert mock_exec.called_once_with(
         "ssh-copy-id", "ssh-copy-id", "-o", "Hostname=192.0.2.1", "host1"
     )
+
+
+def test_main_list(monkeypatch, capsys):
+    monkeypatch.setattr(main.probe, "ping", lambda host: host.name == "host1")
+    main.main(cli_args="--list --probe ping --workers 2 --no-color")
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].startswith("Hostname")
+    assert sorted(line.split()[2] for line in out[1:]) == ["offline", "online"]
+
+
+def test_main_list_cached(monkeypatch, capsys):
+    monkeypatch.setattr(main.probe, "ping", lambda host: True)
+    main.main(cli_args="--list --probe ping --no-color")
+    monkeypatch.setattr(main.probe, "ping", Mock(side_effect=AssertionError))
+    capsys.readouterr()
+    main.main(cli_args="--list --probe ping --no-color")
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].split() == ["Hostname", "Address", "Status", "Age", "URL"]
+    assert [line.split()[2:4] for line in out[1:]] == [["online", "0s"]] * 2
+
+
+def test_main_list_group(monkeypatch, capsys, tmp_path):
+    inv = tmp_path / "groups.ini"
+    inv.write_text(
+        "[web]\nweb1 ansible_host=192.0.2.1\n[db]\ndb1 ansible_host=192.0.2.2\n"
+    )
+    monkeypatch.setattr(main.probe, "ping", lambda host: True)
+    main.main(cli_args=f"-i {inv} --list -g db --probe ping --no-color")
+    out = capsys.readouterr().out.splitlines()
+    assert [line.split()[0] for line in out[1:]] == ["db1"]
+    with pytest.raises(hedgehog.Error, match="group with name: nope"):
+        main.main(cli_args=f"-i {inv} --list -g nope")
+
+
+def test_main_ssh_port_and_user(mock_exec, tmp_path):
+    inv = tmp_path / "port.ini"
+    inv.write_text("web1 ansible_host=192.0.2.1 ansible_port=2222 ansible_user=www\n")
+    main.main(cli_args=f"-i {inv} web1")
+    mock_exec.assert_called_once_with(
+        "ssh",
+        "ssh",
+        "-o",
+        "Hostname=192.0.2.1",
+        "-o",
+        "Port=2222",
+        "-o",
+        "User=www",
+        *control.options(),
+        "web1",
+    )
+
+
+def test_main_multiple_inventories(mock_exec, tmp_path, monkeypatch):
+    first = tmp_path / "first.ini"
+    first.write_text("lima ansible_host=192.0.2.1\n")
+    second = tmp_path / "second.ini"
+    second.write_text("lima ansible_host=192.0.2.2\n")
+    main.main(cli_args=f"-i {first} -i {second} lima")
+    assert mock_exec.call_args.args[3] == "Hostname=192.0.2.2"
+    monkeypatch.setenv("ANSIBLE_INVENTORY", f"{second},{first}")
+    main.main(cli_args="lima")
+    assert mock_exec.call_args.args[3] == "Hostname=192.0.2.1"
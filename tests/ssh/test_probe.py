@@ -0,0 +1,233 @@
+import asyncio
+import socket
+import threading
+import time
+
+from unittest.mock import Mock
+
+import pytest
+
+from hedgehog.ssh import ansible, probe
+
+HOSTS = [ansible.Host(f"host{i}", f"192.0.2.{i}") for i in range(20)]
+
+
+def test_probe_hosts_completion_order():
+    def check(host):
+        time.sleep(0.1 if host.name == "host0" else 0)
+        return host.name != "host1"
+
+    results = list(probe.probe_hosts(HOSTS, workers=4, check=check))
+    assert len(results) == len(HOSTS)
+    assert results[-1].host.name == "host0"
+    assert {r.host.name for r in results if not r.online} == {"host1"}
+    assert all(r.rtt is not None for r in results)
+
+
+def test_probe_hosts_bounded_concurrency():
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def check(host):
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        return True
+
+    assert all(r.online for r in probe.probe_hosts(HOSTS, workers=3, check=check))
+    assert max_running == 3
+
+
+def test_probe_hosts_deadline():
+    event = threading.Event()
+
+    def check(host):
+        if host.name == "host2":
+            event.wait(5)
+        return True
+
+    start = time.monotonic()
+    results = list(probe.probe_hosts(HOSTS, deadline=0.2, check=check))
+    event.set()
+    assert time.monotonic() - start < 2
+    assert len(results) == len(HOSTS)
+    assert results[-1] == probe.Result(HOSTS[2], None, None)
+
+
+def test_probe_hosts_check_fails():
+    def check(host):
+        raise OSError("no ping")
+
+    results = list(probe.probe_hosts(HOSTS[:2], check=check))
+    assert [r.online for r in results] == [False, False]
+
+
+def test_check_hosts_tcp():
+    server = socket.create_server(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    closed = socket.create_server(("127.0.0.1", 0))
+    closed_port = closed.getsockname()[1]
+    closed.close()
+    hosts = [ansible.Host("open", "127.0.0.1"), ansible.Host("refused", "127.0.0.1")]
+    with server:
+        results = {
+            r.host.name: r.online
+            for r in probe.check_hosts(hosts[:1], backend="tcp", port=port)
+        }
+        results.update(
+            (r.host.name, r.online)
+            for r in probe.check_hosts(hosts[1:], backend="tcp", port=closed_port)
+        )
+    # A refused connection means the host is up.
+    assert results == {"open": True, "refused": True}
+
+
+def test_check_hosts_tcp_unresolvable():
+    hosts = [ansible.Host("bad", "host.invalid")]
+    assert [r.online for r in probe.check_hosts(hosts, backend="tcp")] == [False]
+
+
+def test_check_hosts_async_deadline():
+    async def check(host):
+        await asyncio.sleep(5 if host.name == "host2" else 0)
+        return True
+
+    start = time.monotonic()
+    results = list(probe.probe_hosts_async(HOSTS, deadline=0.2, check=check))
+    assert time.monotonic() - start < 2
+    assert len(results) == len(HOSTS)
+    assert results[-1] == probe.Result(HOSTS[2], None, None)
+
+
+def test_check_hosts_async_bounded_concurrency():
+    running = 0
+    max_running = 0
+
+    async def check(host):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return True
+
+    results = probe.probe_hosts_async(HOSTS, workers=3, check=check)
+    assert all(r.online for r in results)
+    assert max_running == 3
+
+
+def test_check_hosts_auto(monkeypatch):
+    used = []
+    monkeypatch.setattr(probe, "icmp_available", lambda: False)
+    monkeypatch.setattr(probe, "probe_hosts_async", lambda *a, **kw: used.append(kw))
+    probe.check_hosts(HOSTS, backend="auto")
+    assert used and used[0]["check"] is not probe.icmp_check
+
+
+def test_icmp_echo_request_checksum():
+    packet = probe._icmp_echo_request(8, 1, b"abcd")
+    assert packet[:2] == b"\x08\x00"
+    assert probe._checksum(packet) == 0
+
+
+@pytest.mark.skipif(
+    not probe.icmp_available(), reason="unprivileged ICMP sockets not allowed"
+)
+def test_check_hosts_icmp():
+    hosts = [ansible.Host("localhost", "127.0.0.1")]
+    assert [r.online for r in probe.check_hosts(hosts, backend="icmp")] == [True]
+
+
+def test_check_hosts_cached(monkeypatch):
+    checked = []
+
+    def check_hosts(hosts, **options):
+        for host in hosts:
+            checked.append(host.name)
+            yield probe.Result(host, host.name != "host1", 0.01)
+
+    monkeypatch.setattr(probe, "check_hosts", check_hosts)
+    first = list(probe.check_hosts_cached(HOSTS[:3]))
+    assert [r.age for r in first] == [None] * 3
+    assert checked == ["host0", "host1", "host2"]
+
+    checked.clear()
+    second = list(probe.check_hosts_cached(HOSTS[:4]))
+    assert checked == ["host3"]
+    assert [r.online for r in second] == [True, False, True, True]
+    assert all(r.age >= 0 for r in second[:3])
+
+    checked.clear()
+    list(probe.check_hosts_cached(HOSTS[:4], ttl=0))
+    assert checked == ["host0", "host1", "host2", "host3"]
+
+
+def test_check_hosts_cached_stale(monkeypatch):
+    monkeypatch.setattr(
+        probe,
+        "check_hosts",
+        lambda hosts, **kw: (probe.Result(h, True, 0.01) for h in hosts),
+    )
+    list(probe.check_hosts_cached(HOSTS[:2]))
+    refreshed = []
+    monkeypatch.setattr(
+        probe,
+        "_refresh_in_background",
+        lambda path, hosts, options: refreshed.extend(h.name for h in hosts),
+    )
+    monkeypatch.setattr(probe, "check_hosts", Mock(side_effect=AssertionError))
+    later = time.time() + 120
+    monkeypatch.setattr(probe.time, "time", lambda: later)
+    # Stale results are served right away, and refreshed in the background.
+    results = list(probe.check_hosts_cached(HOSTS[:2], ttl=60))
+    assert [r.online for r in results] == [True, True]
+    assert all(r.age >= 120 for r in results)
+    assert refreshed == ["host0", "host1"]
+
+
+def test_refresh_in_background(tmp_path, monkeypatch):
+    # localhost answers on a closed port with a refused connection.
+    hosts = [ansible.Host("localhost", "127.0.0.1")]
+    path = tmp_path / "liveness.pickle"
+    probe._refresh_in_background(path, hosts, dict(backend="tcp", port=1))
+    for _ in range(100):
+        if (entry := probe.LivenessCache(path).get("127.0.0.1")) is not None:
+            break
+        time.sleep(0.1)
+    assert entry.online
+
+
+def test_refresh_in_background_once(tmp_path, monkeypatch):
+    started = []
+    popen = probe.subprocess.Popen
+
+    def spy(*args, **kwargs):
+        started.append(popen(*args, **kwargs))
+        return started[-1]
+
+    monkeypatch.setattr(probe.subprocess, "Popen", spy)
+    hosts = [ansible.Host("localhost", "127.0.0.1")]
+    path = tmp_path / "liveness.pickle"
+    probe._refresh_in_background(path, hosts, dict(backend="tcp", port=1))
+    probe._refresh_in_background(path, hosts, dict(backend="tcp", port=1))
+    assert len(started) == 1
+    # The lock is released when the refresh is done.
+    started[0].wait(10)
+    probe._refresh_in_background(path, hosts, dict(backend="tcp", port=1))
+    assert len(started) == 2
+    started[1].wait(10)
+
+
+def test_liveness_cache_skips_unknown(monkeypatch):
+    monkeypatch.setattr(
+        probe,
+        "check_hosts",
+        lambda hosts, **kw: (probe.Result(h, None, None) for h in hosts),
+    )
+    list(probe.check_hosts_cached(HOSTS[:2]))
+    assert probe.LivenessCache().get(HOSTS[0].address) is None
@@ -0,0 +1,97 @@
+import io
+import os
+import textwrap
+
+import pytest
+
+import hedgehog
+from hedgehog.ssh import ansible, main, remote
+
+HOSTS = [ansible.Host("host1", "192.0.2.1"), ansible.Host("remote.example.com", "::1")]
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    """Put ssh on PATH which runs commands locally."""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    ssh = bindir / "ssh"
+    ssh.write_text(
+        textwrap.dedent(
+            f"""\
+            #!/bin/sh
+            for arg; do host=$cmd; cmd=$arg; done
+            echo "$@" >> "{tmp_path}/ssh.log"
+            export TARGET=$host
+            $cmd
+            """
+        )
+    )
+    ssh.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    return tmp_path
+
+
+@pytest.fixture
+def script(tmp_path):
+    path = tmp_path / "script.sh"
+    path.write_text('echo "hello from $TARGET"\necho oops >&2\n[ "$TARGET" = host1 ]\n')
+    return path
+
+
+def test_run_on_hosts(fake_ssh, script, capsys):
+    outcomes = remote.run_on_hosts(HOSTS, script.read_bytes(), ["-v"], workers=2)
+    assert outcomes == [remote.Outcome(HOSTS[0], 0), remote.Outcome(HOSTS[1], 1)]
+    out, err = capsys.readouterr()
+    assert sorted(out.splitlines()) == [
+        "host1              | hello from host1",
+        "remote.example.com | hello from remote.example.com",
+    ]
+    # Leave out log messages.
+    assert sorted(line for line in err.splitlines() if " | " in line) == [
+        "host1              | oops",
+        "remote.example.com | oops",
+    ]
+    ssh_log = (fake_ssh / "ssh.log").read_text().splitlines()
+    assert len(ssh_log) == 2
+    assert all(
+        line.endswith(" -v host1 sh -s") for line in ssh_log if "192.0.2.1" in line
+    )
+
+
+def test_run_on_hosts_ssh_missing(script, monkeypatch, capsys):
+    monkeypatch.setenv("PATH", "")
+    outcomes = remote.run_on_hosts(HOSTS[:1], script.read_bytes())
+    assert outcomes == [remote.Outcome(HOSTS[0], 255)]
+    assert "Failed to run ssh" in capsys.readouterr().err
+
+
+def test_main_remote_cmd_hosts(fake_ssh, script, capsys):
+    with pytest.raises(hedgehog.Error, match="failed on 1 of 2 hosts") as excinfo:
+        main.main(cli_args=f"--no-color -c {script} -- -v host1 remote.example.com")
+    assert excinfo.value.retcode == 1
+    out = capsys.readouterr().out.splitlines()
+    assert out[-3:] == [
+        "Hostname            Exit code",
+        "host1               0",
+        "remote.example.com  1",
+    ]
+
+
+def test_main_remote_cmd_group(fake_ssh, script, tmp_path, capsys):
+    inv = tmp_path / "groups.ini"
+    inv.write_text("[web]\nhost1 ansible_host=192.0.2.1\n")
+    main.main(cli_args=f"--no-color -i {inv} -c {script} -g web")
+    assert "host1 | hello from host1" in capsys.readouterr().out
+
+
+def test_run_on_hosts_large_script(fake_ssh):
+    # Larger than pipe buffers, with output while the script is read.
+    script = b"echo line\n" * 50000
+    assert remote.run_on_hosts(HOSTS[:1], script) == [remote.Outcome(HOSTS[0], 0)]
+
+
+def test_main_remote_cmd_stdin(fake_ssh, monkeypatch, capsys):
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(b"echo from stdin\n")))
+    main.main(cli_args="--no-color -c - host1")
+    assert "host1 | from stdin" in capsys.readouterr().out
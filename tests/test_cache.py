@@ -0,0 +1,57 @@
+import os
+
+from hedgehog import cache
+
+
+def test_file_key_changes_with_contents(tmp_path):
+    source = tmp_path / "source"
+    source.write_text("foo")
+    key = cache.file_key(source)
+    assert key == cache.file_key(str(source))
+    source.write_text("foobar")
+    assert cache.file_key(source) != key
+
+
+def test_file_cache_get_set(tmp_path):
+    source = tmp_path / "source"
+    source.write_text("foo")
+    key = cache.file_key(source)
+    fcache = cache.FileCache("test")
+    assert fcache.get(key) is None
+    assert fcache.get(key, "default") == "default"
+    fcache.set(key, {"a": 1})
+    assert fcache.get(key) == {"a": 1}
+    source.write_text("changed")
+    assert fcache.get(cache.file_key(source)) is None
+
+
+def test_file_cache_corrupt_file(tmp_path):
+    source = tmp_path / "source"
+    source.write_text("foo")
+    key = cache.file_key(source)
+    fcache = cache.FileCache("test")
+    fcache.set(key, "value")
+    fcache._cache_path(key[0]).write_bytes(b"garbage")
+    assert fcache.get(key) is None
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("old")
+    cache.atomic_write(path, b"new", mode=0o600)
+    assert path.read_text() == "new"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ["file"]
+
+
+def test_atomic_open_keeps_old_file_on_error(tmp_path):
+    path = tmp_path / "file"
+    path.write_text("old")
+    try:
+        with cache.atomic_open(path, "w") as fp:
+            fp.write("new")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["file"]
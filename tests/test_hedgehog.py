@@ -1,10 +1,17 @@
 import logging
+import os
 import pytest
 import re
 import subprocess
+import sys
 
 import hedgehog
 
+HOOK_MODULES = ["hedgehog.dirstack.main", "hedgehog.fzfdirs.main", "hedgehog.ssh.main"]
+# Max cumulative import time of each of HOOK_MODULES, relative to that of the
+# hedgehog package itself in the same process.
+IMPORT_TIME_RATIO = 2.5
+
 
 @pytest.mark.parametrize(
     "name",
@@ -51,3 +58,69 @@ def test_init():
     assert args.verbose == 2
     assert args.color is False
     assert logging.getLogger().getEffectiveLevel() == logging.WARNING
+
+
+@pytest.mark.parametrize("module", HOOK_MODULES)
+def test_import_defers_heavy_modules(module):
+    """Modules that aren't needed on every code path must be imported lazily."""
+    proc = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print(*sys.modules)"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    loaded = set(proc.stdout.split())
+    assert module in loaded
+    assert not loaded & {"importlib.metadata", "json", "simple_term_menu", "yaml"}
+    assert "termcolor" not in loaded
+
+
+@pytest.mark.parametrize("module", HOOK_MODULES)
+def test_import_time_budget(module, tmp_path):
+    """Fail when startup of the shell hook entry points regresses."""
+    # Measure with bytecode cached, like an installed package, not compile time.
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    env["PYTHONPYCACHEPREFIX"] = str(tmp_path)
+    ratios = []
+    for _ in range(3):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        # Compare with a reference from the same process, which is slowed down
+        # as much by a busy machine.
+        timings = [
+            int(re.search(rf"\|\s*(\d+) \|\s+{re.escape(name)}$", proc.stderr, re.M)[1])
+            for name in (module, "hedgehog")
+        ]
+        ratios.append(timings[0] / timings[1])
+    assert min(ratios) < IMPORT_TIME_RATIO, ratios
+
+
+def test_lazy_import():
+    mod = hedgehog.lazy_import("colorsys")
+    assert "colorsys" in repr(mod)
+    assert mod.rgb_to_hsv(0, 0, 0) == (0, 0, 0)
+
+
+def test_print_codes(monkeypatch):
+    monkeypatch.setenv("FORCE_COLOR", "1")
+    cprint = hedgehog.Print(True)
+    prefix, suffix = cprint.codes("green", attrs=["bold"])
+    assert f"{prefix}text{suffix}" == hedgehog.termcolor.colored(
+        "text", "green", attrs=["bold"]
+    )
+    assert cprint.colored("text", "green", attrs=["bold"]) == f"{prefix}text{suffix}"
+    # Cached
+    assert cprint.codes("green", attrs=["bold"]) == (prefix, suffix)
+    assert len(cprint._codes) == 1
+    cprint.color = False
+    assert cprint.codes("green") == ("", "")
+
+
+def test_print_write_lines(capsys):
+    hedgehog.Print(False).write_lines(f"line {i}" for i in range(3))
+    assert capsys.readouterr().out == "line 0\nline 1\nline 2\n"